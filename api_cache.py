@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class ApiCache:
+    ''' Store raw API responses on disk so that they need not be downloaded again.
+    Responses are keyed by endpoint, action and request parameters (title, props, etc.).
+    They're compressed and kept in a single SQLite file. When the file exceeds its size cap,
+    least recently used responses are evicted.
+    In replay mode, responses come only from the cache and the network is never used.
+    In bypass mode, responses are never read from the cache but they're still saved.
+    '''
+
+    def __init__(self, **kwargs):
+        self.config = kwargs
+        if 'file' not in self.config or not self.config['file']:
+            self.config['file'] = 'output/api_cache.db'
+        if 'max_mb' not in self.config or not self.config['max_mb']:
+            self.config['max_mb'] = 1024
+        self.replay = bool(self.config.get('replay', False))
+        self.bypass = bool(self.config.get('bypass', False))
+        self.max_size = self.config['max_mb'] * 1024 * 1024
+        self.hits, self.misses = 0, 0
+
+        path = os.path.dirname(self.config['file'])
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+        # Shared by threads of the mwclient backend
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.config['file'], check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, endpoint TEXT, action TEXT, title TEXT, props TEXT,
+            body BLOB, size INTEGER, last_used REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    @staticmethod
+    def make_key(endpoint, action, params):
+        # Continuation parameters are part of the key: each page of a response is cached
+        params = sorted((k, str(v)) for k, v in params.items())
+        return hashlib.sha1(json.dumps([endpoint, action, params]).encode('utf-8')).hexdigest()
+
+    def get(self, endpoint, action, params):
+        ''' Return the cached response or None if the response is not cached.
+        '''
+        if self.bypass:
+            self.misses += 1
+            return None
+
+        key = self.make_key(endpoint, action, params)
+        with self.lock:
+            row = self.db.execute('SELECT body FROM responses WHERE key=?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute('UPDATE responses SET last_used=? WHERE key=?', (time.time(), key))
+            self.db.commit()
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, endpoint, action, params, content):
+        key = self.make_key(endpoint, action, params)
+        body = zlib.compress(json.dumps(content, separators=(',', ':')).encode('utf-8'))
+        title = params.get('page', params.get('titles', ''))
+        props = params.get('prop', '')
+
+        with self.lock:
+            row = self.db.execute('SELECT size FROM responses WHERE key=?', (key,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?,?)',
+                (key, endpoint, action, title, props, body, len(body), time.time()))
+            self.size += len(body)
+            if self.size > self.max_size:
+                self.evict()
+            self.db.commit()
+
+    def evict(self):
+        # Evict down to 90% of the cap so that we don't evict on every put
+        target = 0.9 * self.max_size
+        rows = self.db.execute('SELECT key, size FROM responses ORDER BY last_used')
+        keys = []
+        for key, size in rows:
+            if self.size <= target: break
+            keys.append((key,))
+            self.size -= size
+        self.db.executemany('DELETE FROM responses WHERE key=?', keys)
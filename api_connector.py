@@ -2,13 +2,21 @@ from datetime import datetime, timedelta
 import json
 import re
 import sys
+import threading
+import time
 import mwclient
+import requests
+from api_cache import ApiCache
+from crawl_stats import stats
+from scheduler import ThrottledError
 
 
 class ApiConnector:
     ''' Call an API to request an article.
     '''
 
+    is_local = False # articles are fetched over the network
+
     def __init__(self, **kwargs):
         self.config = kwargs
         if 'endpoint' not in self.config or not self.config['endpoint']:
@@ -19,12 +27,16 @@ class ApiConnector:
         if 'func' in self.config:
             if getattr(self, self.config['func'], None) is None:
                 sys.exit("ERR: API function '{}' is missing. Use one of {}. Quitting...".format(
-                    self.config['func'], '(get_text, get_parsed_text, get_info)'))
+                    self.config['func'], '(get_text, get_texts, get_parsed_text, get_info)'))
             else:
                 self.func = getattr(self, self.config['func'])
 
         if 'parse' not in self.config or not self.config['parse']:
             self.config['parse'] = 'categories|displaytitle|links|revid|sections|templates|text|wikitext'
+        if 'html' in self.config and not self.config['html']:
+            # HTML (prop text) is the bulk of a response: get it only if it's used
+            props = [p for p in self.config['parse'].split('|') if p != 'text']
+            self.config['parse'] = '|'.join(props)
 
         if 'query' not in self.config or not self.config['query']:
             self.config['query'] = {
@@ -54,28 +66,219 @@ class ApiConnector:
                 }
             }
 
-        self.site = mwclient.Site(self.config['endpoint'])
+        if 'scheme' not in self.config or not self.config['scheme']:
+            self.config['scheme'] = 'https'
+
+        # Bulk fetch with get_texts(): titles per call adapt to the size of articles
+        if 'bulk_titles' not in self.config or not self.config['bulk_titles']:
+            self.config['bulk_titles'] = 50 # API's limit for content of many pages
+        if 'bulk_mb' not in self.config or not self.config['bulk_mb']:
+            self.config['bulk_mb'] = 4 # half of API's limit on size of a response
+        self.bulk_size = self.config['bulk_titles']
+        self.text_size = None
+        self.bulk_lock = threading.Lock() # calls from many threads update sizes
+
+        # Seconds of replication lag beyond which the server refuses requests
+        if 'maxlag' not in self.config or not self.config['maxlag']:
+            self.config['maxlag'] = 5
+
+        self.cache = None
+        if 'cache' in self.config and self.config['cache'].get('enabled', False):
+            self.cache = ApiCache(**self.config['cache'])
+        elif 'cache' in self.config and self.config['cache'].get('replay', False):
+            sys.exit("ERR: Replay needs the API cache but it's disabled in configuration. Quitting...")
+
+        self.local = threading.local() # size of the last response of each thread
+        self.connect()
         self.start_date = (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d')+'T00:00:00Z'
 
+    def connect(self):
+        ''' Open the connection to the API endpoint.
+        mwclient makes a siteinfo call here, so do this once per process.
+        '''
+        if self.cache is not None and self.cache.replay:
+            self.site = None # never used
+        else:
+            # Don't let mwclient sleep and retry: throttling is handled by our scheduler
+            self.site = mwclient.Site(self.config['endpoint'], scheme=self.config['scheme'], max_retries=0)
+            self.site.connection.hooks['response'].append(self.on_response)
+
+    def on_response(self, response, *args, **kwargs):
+        # mwclient raises on a throttled response without its delay: keep it
+        self.local.nbytes = len(response.content)
+        self.local.retry_after = response.headers.get('Retry-After')
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
+    def call(self, action, **params):
+        ''' Make a single GET request to the API and return the decoded response.
+        All API requests go through here. Responses are served from the cache if possible.
+        '''
+        content = self.lookup(action, params)
+        if content is None:
+            try:
+                content = self.request(action, **params)
+            except mwclient.errors.APIError as e:
+                content = {'error': {'code': e.code, 'info': e.info}}
+            self.store(action, params, content)
+        return self.check_response(content, params)
+
+    def request(self, action, **params):
+        start = time.perf_counter()
+        self.local.nbytes = 0
+        self.local.retry_after = None
+        try:
+            return self.site.get(action, maxlag=self.config['maxlag'], **params)
+        except mwclient.errors.MaximumRetriesExceeded:
+            # mwclient would have retried: server is lagged or returned 5xx
+            raise ThrottledError(ThrottledError.parse_retry_after(self.local.retry_after), 'server busy')
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 429:
+                raise ThrottledError(ThrottledError.parse_retry_after(e.response.headers.get('Retry-After')),
+                                     'HTTP 429')
+            raise
+        finally:
+            stats.observe_call(action, time.perf_counter() - start, self.local.nbytes)
+
+    def lookup(self, action, params):
+        if self.cache is None:
+            return None
+        content = self.cache.get(self.config['endpoint'], action, params)
+        if content is None and self.cache.replay:
+            raise mwclient.errors.APIError('cachemiss', 'Response is not in the cache', params)
+        return content
+
+    def store(self, action, params, content):
+        # Only errors that will recur are cached, not those due to server load
+        permanent_errors = ('missingtitle', 'invalidtitle', 'nosuchpageid', 'pagecannotexist')
+        if self.cache is not None:
+            if 'error' not in content or content['error'].get('code') in permanent_errors:
+                self.cache.put(self.config['endpoint'], action, params, content)
+
+    def check_response(self, content, params):
+        if 'error' in content:
+            if content['error'].get('code') in ('maxlag', 'ratelimited'):
+                raise ThrottledError(reason=content['error']['code'])
+            raise mwclient.errors.APIError(content['error'].get('code'),
+                                           content['error'].get('info'), params)
+        return content
+
     def get_text(self, title):
         ''' Give an article title, return the full text in Wikitext format.
         The text contains unexpanded transcluded content.
         This method makes a single API call.
         '''
-        content = self.site.pages[title]
+        # Wikitext format: same request that mwclient's Page.text() makes
+        content = self.call('query', **self.text_params(title))
+        return self.read_text(title, content)
 
-        # Wikitext format: mwclient uses action=query?prop=revisions&rvprop=content|timestamp&rvlimit=1
-        text = content.text()
+    def text_params(self, title):
+        return {
+            'titles': title,
+            'prop': 'revisions',
+            'rvprop': 'content|timestamp',
+            'rvslots': 'main',
+            'rvlimit': 1
+        }
 
-        # These will each make a separate API call: not ideal way to use mwclient
-        # content.categories(), content.embeddedin(), content.links(),
-        # content.revisions(), content.templates()
+    def read_text(self, title, content):
+        text = ''
+        for pg in content['query']['pages'].values():
+            if 'revisions' in pg and pg['revisions']:
+                rev = pg['revisions'][0]
+                text = rev['slots']['main']['*'] if 'slots' in rev else rev['*']
 
         return {
             'title': title,
             'text': text
         }
 
+    def get_texts(self, titles):
+        ''' Given up to 50 article titles, return full text of each in Wikitext format.
+        All articles are queried with a single API call. A large response is paginated,
+        resulting in more calls. Redirects are followed, as in get_parsed_text().
+        Use attribute 'bulk_size' as the number of titles: it keeps pagination rare.
+        '''
+        params = self.texts_params(titles)
+
+        # Call multiple times if response is paginated
+        all_content = []
+        continues = {}
+        while True:
+            content = self.call('query', **params, **continues)
+            all_content.append(content)
+            if 'continue' in content:
+                continues = content['continue']
+            else:
+                break
+
+        return self.read_texts(titles, all_content)
+
+    def texts_params(self, titles):
+        if not isinstance(titles, (list, tuple)): # called for a single title
+            titles = [titles]
+        # Targets can't be requested: a title with many targets has '|' in it
+        names = dict.fromkeys(t.split('#')[0] for t in titles)
+        return {
+            'titles': '|'.join(names),
+            'prop': 'revisions',
+            'rvprop': 'content|ids',
+            'rvslots': 'main',
+            'redirects': 1
+        }
+
+    def read_texts(self, titles, all_content):
+        if not isinstance(titles, (list, tuple)):
+            titles = [titles]
+
+        # Pages of a paginated response: some revisions are only in later responses
+        pages, normalized, redirects = {}, {}, {}
+        for content in all_content:
+            query = content.get('query', {})
+            normalized.update((n['from'], n['to']) for n in query.get('normalized', []))
+            redirects.update((r['from'], r['to']) for r in query.get('redirects', []))
+            for pg in query.get('pages', {}).values():
+                article = pages.setdefault(pg['title'], {'title': pg['title'], 'text': ''})
+                if 'pageid' in pg:
+                    article['pageid'] = pg['pageid']
+                if 'revisions' in pg and pg['revisions']:
+                    rev = pg['revisions'][0]
+                    article['revid'] = rev['revid']
+                    article['text'] = rev['slots']['main']['*'] if 'slots' in rev else rev['*']
+
+        # Redirects and targets of the requested titles are kept with the page, as in parsing
+        for title in titles:
+            name = title.split('#')[0]
+            name = normalized.get(name, name)
+            article = pages.get(redirects.get(name, name))
+            if article is None: continue
+            if name in redirects:
+                redirect = {'from': name, 'to': article['title']}
+                article.setdefault('redirects', [])
+                if redirect not in article['redirects']: article['redirects'].append(redirect)
+            targets = self.split_targets(title)
+            if targets:
+                article.setdefault('targets', []).extend(targets)
+
+        articles = list(pages.values())
+        self.update_bulk_size(articles)
+        return articles
+
+    def update_bulk_size(self, articles):
+        ''' Ask for as many titles as fit in a response of configured size, given the
+        average size of articles seen so far. Sizes are in characters: close enough.
+        '''
+        sizes = [len(a['text']) for a in articles if a['text']]
+        if not sizes:
+            return
+        size = sum(sizes) / len(sizes)
+        with self.bulk_lock:
+            self.text_size = size if self.text_size is None else 0.8 * self.text_size + 0.2 * size
+            self.bulk_size = max(1, min(self.config['bulk_titles'],
+                                        int(self.config['bulk_mb'] * 1024 * 1024 / self.text_size)))
+
     def get_parsed_text(self, title):
         ''' Given an article title, return full text in Wikitext and HTML formats.
         Other relevant information are also returned from parsing the article's text.
@@ -83,15 +286,10 @@ class ApiConnector:
         excluded. Wikitext contains all unexpanded transcluded content.
         This method makes a single API call.
         '''
-        # Remove targets (section names separated by |) for request but track them for later use
-        targets = re.findall(r'#(.*)', title)
-        if targets:
-            targets = targets[0].split('|')
+        targets = self.split_targets(title)
 
         try:
-            content = self.site.get('parse', page=title, prop=self.config['parse'], redirects=1)
-            if 'warnings' in content:
-                print("WARN: Some warnings in the API response: {}".format(content['warnings']))
+            content = self.call('parse', **self.parse_params(title))
         except mwclient.errors.APIError:
             # one reason is that the page doesn't exist
             return {
@@ -99,8 +297,29 @@ class ApiConnector:
                 'text': ''
             }
 
+        return self.read_parsed_text(content, targets)
+
+    def split_targets(self, title):
+        # Remove targets (section names separated by |) for request but track them for later use
+        targets = re.findall(r'#(.*)', title)
+        if targets:
+            targets = targets[0].split('|')
+        return targets
+
+    def parse_params(self, title):
+        return {
+            'page': title,
+            'prop': self.config['parse'],
+            'redirects': 1
+        }
+
+    def read_parsed_text(self, content, targets):
+        if 'warnings' in content:
+            print("WARN: Some warnings in the API response: {}".format(content['warnings']))
+
         # Post-processing
-        content['parse']['html'] = content['parse']['text']['*']
+        if 'text' in content['parse']:
+            content['parse']['html'] = content['parse']['text']['*']
         content['parse']['text'] = content['parse']['wikitext']['*']
         del(content['parse']['wikitext'])
         if targets:
@@ -110,33 +329,93 @@ class ApiConnector:
 
         return content['parse']
 
-    def get_info(self, titles):
+    def get_info(self, titles, query=None):
         ''' Given one or more article titles, return essential information.
         All articles queried with a single API call. However, since there might be lot
         of data to retrieve, the response is often paginated, resulting in multiple calls.
         Only an extract of the article text is returned, if requested.
+        Optional query (same form as in configuration) overrides the configured one.
         '''
-        childprops = {}
-        for k, v in self.config['query'].items():
-            childprops.update(v)
-
-        if isinstance(titles, list): # else: called for a single title
-            titles = "|".join(titles)
-        props = "|".join(self.config['query'].keys())
-        continues = {}
+        params = self.info_params(titles, query)
 
         # Call multiple times if response is paginated
         all_content = []
-        num_calls = 0
+        continues = {}
         while True:
-            num_calls += 1
-            content = self.site.get('query', titles=titles, prop=props, redirects=1, **childprops, **continues)
+            content = self.call('query', **params, **continues)
             all_content.append(content)
             if 'continue' in content:
                 continues = content['continue']
             else:
                 break
 
+        return self.read_info(all_content)
+
+    def get_lastrevids(self, titles):
+        ''' Given up to 50 article titles, return page ID and ID of latest revision of each.
+        Use this to find out cheaply which articles have changed since they were crawled.
+        '''
+        return self.get_info(titles, {'info': {}})
+
+    def resolve_titles(self, titles):
+        ''' Given up to 50 article titles, find out cheaply what each of them is: a missing page,
+        a redirect or an article. Returns for each title the title of the page it resolves to,
+        its page ID and namespace, and the redirect followed, if any.
+        Use this before fetching full text of titles that may be redlinks or redirects.
+        '''
+        content = self.call('query', **self.resolve_params(titles))
+        return self.read_resolved(titles, content)
+
+    def resolve_params(self, titles):
+        if not isinstance(titles, (list, tuple)): # called for a single title
+            titles = [titles]
+        names = dict.fromkeys(t.split('#')[0] for t in titles)
+        return {
+            'titles': '|'.join(names),
+            'prop': 'info',
+            'redirects': 1
+        }
+
+    def read_resolved(self, titles, content):
+        if not isinstance(titles, (list, tuple)):
+            titles = [titles]
+        query = content.get('query', {})
+        normalized = {n['from']: n['to'] for n in query.get('normalized', [])}
+        redirects = {r['from']: r for r in query.get('redirects', [])}
+        pages = {pg['title']: pg for pg in query.get('pages', {}).values()}
+
+        resolved = []
+        for title in titles:
+            name = title.split('#')[0]
+            name = normalized.get(name, name)
+            redirect, dst = redirects.get(name), name
+            for _ in range(len(redirects)): # double redirects are followed too
+                if dst not in redirects: break
+                dst = redirects[dst]['to']
+            pg = pages.get(dst, {})
+            resolved.append({
+                'title': title,
+                'to': pg.get('title', dst),
+                'pageid': pg.get('pageid'),
+                'ns': pg.get('ns'),
+                'missing': 'pageid' not in pg, # also invalid titles and interwiki links
+                'redirect': {'from': name, 'to': pg.get('title', dst)} if redirect else None
+            })
+        return resolved
+
+    def info_params(self, titles, query=None):
+        if query is None: query = self.config['query']
+        childprops = {}
+        for k, v in query.items():
+            childprops.update(v)
+
+        if isinstance(titles, (list, tuple)): # else: called for a single title
+            titles = "|".join(titles)
+        props = "|".join(query.keys())
+
+        return dict(titles=titles, prop=props, redirects=1, **childprops)
+
+    def read_info(self, all_content):
         # Post-process the response to only what we need
         cum_content = {}
         for content in all_content:
@@ -180,3 +459,21 @@ class ApiConnector:
         cum_content = [v for k, v in cum_content.items()]
 
         return cum_content
+
+
+def create_connector(**kwargs):
+    ''' Return an API connector for the backend named in the configuration.
+    '''
+    backend = kwargs.get('backend', 'mwclient')
+    if backend == 'async':
+        # aiohttp is needed only for this backend
+        from async_connector import AsyncApiConnector
+        return AsyncApiConnector(**kwargs)
+    elif backend == 'mwclient':
+        return ApiConnector(**kwargs)
+    elif backend == 'dump':
+        from dump_connector import DumpConnector
+        return DumpConnector(**kwargs)
+    else:
+        sys.exit("ERR: API backend '{}' is unknown. Use one of {}. Quitting...".format(
+            backend, '(mwclient, async, dump)'))
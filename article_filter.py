@@ -1,62 +1,91 @@
 import re
 import string
-import spacy
+from spacy.lang.en.stop_words import STOP_WORDS
 
 
 class ArticleFilter:
     ''' Identify articles that need not be crawled. 
+    Namespace and interwiki prefixes are matched with a single set lookup. Decisions are
+    remembered, so that titles seen again in later batches aren't classified again.
     '''
 
+    # Filter by namespaces (controlled by config)
+    # We allow an optional _talk, although talk pages are not for all of these
+    special_pages = (
+        # https://en.wikipedia.org/wiki/Help:Special_page
+        'Category', 'Draft', 'File', 'Help', 'MediaWiki', 'Module',
+        'Portal', 'Template', 'TimedText', 'User', 'Wikipedia',
+        'Book', 'Education Program', 'Gadget', 'Gadget Definition',
+        'Special', 'Media',
+        # Others such as Wiktionary, MediaWiki, etc.
+        'Bugzilla', 'commons', 'Image', 'meta', 'mw', 's', 'wikt', 'WP',
+        # https://en.wikipedia.org/wiki/List_of_Wikipedias
+        'aa', 'ab', 'ace', 'ady', 'af', 'ak', 'als', 'am', 'an', 'ang', 'ar', 'arc', 'arz', 'as', 'ast', 'atj', 'av', 'ay', 'az', 'azb', 'ba', 'ban', 'bar', 'bat-smg', 'bcl', 'be', 'be-x-old', 'bg', 'bh', 'bi', 'bjn', 'bm', 'bn', 'bo', 'bpy', 'br', 'bs', 'bug', 'bxr', 'ca', 'cbk-zam', 'cdo', 'ce', 'ceb', 'ch', 'cho', 'chr', 'chy', 'ckb', 'co', 'cr', 'crh', 'cs', 'csb', 'cu', 'cv', 'cy', 'da', 'de', 'din', 'diq', 'dsb', 'dty', 'dv', 'dz', 'ee', 'el', 'eml', 'eo', 'es', 'et', 'eu', 'ext', 'fa', 'ff', 'fi', 'fiu-vro', 'fj', 'fo', 'fr', 'frp', 'frr', 'fur', 'fy', 'ga', 'gag', 'gan', 'gd', 'gl', 'glk', 'gn', 'gom', 'gor', 'got', 'gu', 'gu', 'gv', 'ha', 'hak', 'haw', 'he', 'hi', 'hif', 'ho', 'hr', 'hsb', 'ht', 'hu', 'hy', 'hz', 'ia', 'id', 'ie', 'ig', 'ii', 'ik', 'ilo', 'inh', 'io', 'is', 'it', 'iu', 'ja', 'jam', 'jbo', 'jv', 'ka', 'kaa', 'kab', 'kbd', 'kbp', 'kg', 'ki', 'kj', 'kk', 'kl', 'km', 'kn', 'ko', 'koi', 'kr', 'krc', 'ks', 'ksh', 'ku', 'kv', 'kw', 'ky', 'la', 'lad', 'lb', 'lbe', 'lez', 'lfn', 'lg', 'li', 'lij', 'lmo', 'ln', 'lo', 'lrc', 'lt', 'ltg', 'lv', 'mai', 'map-bms', 'mdf', 'mg', 'mh', 'mhr', 'mi', 'min', 'mk', 'ml', 'mn', 'mo', 'mr', 'mrj', 'ms', 'mt', 'mus', 'mwl', 'my', 'myv', 'mzn', 'na', 'nah', 'nap', 'nds', 'nds-nl', 'ne', 'new', 'ng', 'nl', 'nn', 'no', 'nov', 'nrm', 'nso', 'nv', 'ny', 'oc', 'olo', 'om', 'or', 'os', 'pa', 'pag', 'pam', 'pap', 'pcd', 'pdc', 'pfl', 'pi', 'pih', 'pl', 'pms', 'pnb', 'pnt', 'ps', 'pt', 'qu', 'rm', 'rmy', 'rn', 'ro', 'roa-rup', 'roa-tara', 'ru', 'rue', 'rw', 'sa', 'sah', 'sat', 'sc', 'scn', 'sco', 'sd', 'se', 'sg', 'sh', 'shn', 'si', 'simple', 'sk', 'sl', 'sm', 'sn', 'so', 'sq', 'sr', 'srn', 'ss', 'st', 'stq', 'su', 'sv', 'sw', 'szl', 'ta', 'tcy', 'te', 'tet', 'tg', 'th', 'ti', 'tk', 'tl', 'tn', 'to', 'tpi', 'tr', 'ts', 'tt', 'tum', 'tw', 'ty', 'tyv', 'udm', 'ug', 'uk', 'ur', 'uz', 've', 'vec', 'vep', 'vi', 'vls', 'vo', 'wa', 'war', 'wo', 'wuu', 'xal', 'xh', 'xmf', 'yi', 'yo', 'za', 'zea', 'zh', 'zh-classical', 'zh-min-nan', 'zh-yue', 'zu'
+    )
+    prefixes = frozenset(p.lower() for p in special_pages)
+
+    max_decisions = 1000000 # forget remembered decisions beyond this
+
     def __init__(self, **kwargs):
         self.config = kwargs
-        self.sp_en = spacy.load('en_core_web_sm')
+        if 'namespace_includes' not in self.config or not self.config['namespace_includes']:
+            self.config['namespace_includes'] = []
+        self.stop_words = STOP_WORDS
         self.read_common_words()
+        self.decisions = {}
 
     def read_common_words(self):
-        if 'common_word_file' not in self.config:
-            self.common_words = set()
+        if 'common_word_file' not in self.config or not self.config['common_word_file']:
+            self.common_words = frozenset()
         else:
             with open(self.config['common_word_file'], 'r', encoding='utf-8') as f:
-                self.common_words = set([word.strip() for word in f.readlines()])
+                self.common_words = frozenset(word.strip().lower() for word in f)
+
+    def get_namespace(self, title):
+        ''' Return namespace or interwiki prefix of the title, or None. '''
+        prefix, sep, rest = (title[1:] if title.startswith(':') else title).partition(':')
+        if not sep:
+            return None
+        lprefix = prefix.lower()
+        if lprefix in self.prefixes or \
+           (lprefix[-5:] in (' talk', '_talk') and lprefix[:-5] in self.prefixes):
+            return prefix
+        return None
 
     def is_allowed(self, title):
-        # Filter by namespaces (controlled by config)
-        # We append an optional _talk, although talk pages are not for all of these
-        special_pages = (
-            # https://en.wikipedia.org/wiki/Help:Special_page
-            'Category', 'Draft', 'File', 'Help', 'MediaWiki', 'Module',
-            'Portal', 'Template', 'TimedText', 'User', 'Wikipedia',
-            'Book', 'Education Program', 'Gadget', 'Gadget Definition',
-            'Special', 'Media',
-            # Others such as Wiktionary, MediaWiki, etc.
-            'Bugzilla', 'commons', 'Image', 'meta', 'mw', 's', 'wikt', 'WP',
-            # https://en.wikipedia.org/wiki/List_of_Wikipedias
-            'aa', 'ab', 'ace', 'ady', 'af', 'ak', 'als', 'am', 'an', 'ang', 'ar', 'arc', 'arz', 'as', 'ast', 'atj', 'av', 'ay', 'az', 'azb', 'ba', 'ban', 'bar', 'bat-smg', 'bcl', 'be', 'be-x-old', 'bg', 'bh', 'bi', 'bjn', 'bm', 'bn', 'bo', 'bpy', 'br', 'bs', 'bug', 'bxr', 'ca', 'cbk-zam', 'cdo', 'ce', 'ceb', 'ch', 'cho', 'chr', 'chy', 'ckb', 'co', 'cr', 'crh', 'cs', 'csb', 'cu', 'cv', 'cy', 'da', 'de', 'din', 'diq', 'dsb', 'dty', 'dv', 'dz', 'ee', 'el', 'eml', 'eo', 'es', 'et', 'eu', 'ext', 'fa', 'ff', 'fi', 'fiu-vro', 'fj', 'fo', 'fr', 'frp', 'frr', 'fur', 'fy', 'ga', 'gag', 'gan', 'gd', 'gl', 'glk', 'gn', 'gom', 'gor', 'got', 'gu', 'gu', 'gv', 'ha', 'hak', 'haw', 'he', 'hi', 'hif', 'ho', 'hr', 'hsb', 'ht', 'hu', 'hy', 'hz', 'ia', 'id', 'ie', 'ig', 'ii', 'ik', 'ilo', 'inh', 'io', 'is', 'it', 'iu', 'ja', 'jam', 'jbo', 'jv', 'ka', 'kaa', 'kab', 'kbd', 'kbp', 'kg', 'ki', 'kj', 'kk', 'kl', 'km', 'kn', 'ko', 'koi', 'kr', 'krc', 'ks', 'ksh', 'ku', 'kv', 'kw', 'ky', 'la', 'lad', 'lb', 'lbe', 'lez', 'lfn', 'lg', 'li', 'lij', 'lmo', 'ln', 'lo', 'lrc', 'lt', 'ltg', 'lv', 'mai', 'map-bms', 'mdf', 'mg', 'mh', 'mhr', 'mi', 'min', 'mk', 'ml', 'mn', 'mo', 'mr', 'mrj', 'ms', 'mt', 'mus', 'mwl', 'my', 'myv', 'mzn', 'na', 'nah', 'nap', 'nds', 'nds-nl', 'ne', 'new', 'ng', 'nl', 'nn', 'no', 'nov', 'nrm', 'nso', 'nv', 'ny', 'oc', 'olo', 'om', 'or', 'os', 'pa', 'pag', 'pam', 'pap', 'pcd', 'pdc', 'pfl', 'pi', 'pih', 'pl', 'pms', 'pnb', 'pnt', 'ps', 'pt', 'qu', 'rm', 'rmy', 'rn', 'ro', 'roa-rup', 'roa-tara', 'ru', 'rue', 'rw', 'sa', 'sah', 'sat', 'sc', 'scn', 'sco', 'sd', 'se', 'sg', 'sh', 'shn', 'si', 'simple', 'sk', 'sl', 'sm', 'sn', 'so', 'sq', 'sr', 'srn', 'ss', 'st', 'stq', 'su', 'sv', 'sw', 'szl', 'ta', 'tcy', 'te', 'tet', 'tg', 'th', 'ti', 'tk', 'tl', 'tn', 'to', 'tpi', 'tr', 'ts', 'tt', 'tum', 'tw', 'ty', 'tyv', 'udm', 'ug', 'uk', 'ur', 'uz', 've', 'vec', 'vep', 'vi', 'vls', 'vo', 'wa', 'war', 'wo', 'wuu', 'xal', 'xh', 'xmf', 'yi', 'yo', 'za', 'zea', 'zh', 'zh-classical', 'zh-min-nan', 'zh-yue', 'zu'
-        )
-        sps = '|'.join(special_pages)
-        m = re.search(r'^:?((?:{})(?:[ _]talk)?):(.*)'.format(sps), title, re.I)
+        ns = self.get_namespace(title)
         mod_title = title
-        if m:
-            if 'namespace_includes' not in self.config or m.group(1) not in self.config['namespace_includes']:
+        if ns is not None:
+            if ns not in self.config['namespace_includes']:
                 return False
             else:
-                mod_title = m.group(2)
+                mod_title = (title[1:] if title.startswith(':') else title)[len(ns)+1:]
 
         # Ignore proper nouns
         # :ignore stopwords, more than one word and all starting with uppercase
         # :remove (): eg. Kenneth D. Bailey (sociologist) --> Kenneth D. Bailey
-        mod_title = re.sub(r'\s*\(.*\)\s*', '', mod_title)
-        words = [w for w in re.split(r'\W+', mod_title) if w and w not in self.sp_en.Defaults.stop_words]
+        # :capitalized common words are not names: eg. Computer Science
+        if '(' in mod_title:
+            mod_title = re.sub(r'\s*\(.*\)\s*', '', mod_title)
+        words = [w for w in re.split(r'\W+', mod_title) if w and w not in self.stop_words]
         if len(words) > 1 and all(w[0] in string.ascii_uppercase for w in words):
-            return False
+            if not self.common_words or not all(w.lower() in self.common_words for w in words):
+                return False
 
         return True
 
     def filter_many(self, titles):
+        ''' Split titles into allowed and discarded ones. '''
         oks = set()
         kos = set()
+        if len(self.decisions) > self.max_decisions:
+            self.decisions.clear()
+        decisions = self.decisions
         for title in titles:
-            if self.is_allowed(title):
+            ok = decisions.get(title)
+            if ok is None:
+                ok = decisions[title] = self.is_allowed(title)
+            if ok:
                 oks.add(title)
             else:
                 kos.add(title)
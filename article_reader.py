@@ -1,6 +1,9 @@
+import multiprocessing
+import os
 import re
+import signal
 import sys
-from parsers import WikitextParser, HtmlParser
+from parsers import HtmlParser, SectionIndex, WikitextParser
 
 
 class ArticleReader:
@@ -12,15 +15,81 @@ class ArticleReader:
         self.wtparser = WikitextParser(**kwargs)
         self.hparser = HtmlParser(**kwargs)
 
-    def get_seed_links(self, text, targets=None):
-        return self.wtparser.get_seed_links(text, targets)
+    def get_seed_links(self, text, targets=None, sections=None):
+        return self.wtparser.get_seed_links(text, targets, sections)
 
-    def get_links(self, title, text, html):
-        links = self.wtparser.get_links(title, text)
-
-        if self.config['transcludes']['enabled']:
-            transcludes = self.wtparser.get_transcludes(text)
+    def get_links(self, title, text, html, sections=None):
+        # One scan of wikitext for both
+        links, transcludes = self.wtparser.get_links_and_transcludes(
+            title, text, transcludes=self.config['transcludes']['enabled'], sections=sections)
+        if html and self.config['transcludes']['enabled']:
             transcludes |= self.hparser.get_transcludes(html)
-        else: transcludes = set()
 
         return links, transcludes
+
+    def read(self, seed, title, text, html, targets):
+        ''' Return links, transcludes and sections of an article.
+        Sections are found once, for parsers that need them and to be saved with the article.
+        '''
+        sections = SectionIndex(text)
+        if seed:
+            return self.get_seed_links(text, targets, sections), set(), sections.sections
+        else:
+            return self.get_links(title, text, html, sections) + (sections.sections,)
+
+    def read_many(self, seed, items):
+        ''' Read articles given as (title, text, html, targets) tuples. '''
+        return [self.read(seed, *item) for item in items]
+
+    def close(self):
+        pass
+
+
+# Reader of a worker process of ArticleReaderPool
+_reader = None
+
+def _init_worker(config):
+    global _reader
+    # Ctrl-C reaches the whole process group: the crawler decides when to stop and closes the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _reader = ArticleReader(**config)
+
+def _read_chunk(seed, chunk):
+    return [_reader.read(seed, *item) for item in chunk]
+
+
+class ArticleReaderPool:
+    ''' Read articles in worker processes so that parsing uses more than one core.
+    Each worker has its own ArticleReader. Articles are sent in chunks of chunk_size,
+    each as a tuple of only the fields that parsers need. Results keep the order of articles.
+    '''
+
+    def __init__(self, workers, chunk_size=8, **kwargs):
+        self.config = kwargs
+        self.workers = workers
+        self.chunk_size = chunk_size or 8
+        # Start workers before any threads or event loops of the parent exist
+        self.pool = multiprocessing.Pool(workers, _init_worker, (kwargs,))
+
+    def read_many(self, seed, items):
+        chunks = [(seed, items[i:i+self.chunk_size]) for i in range(0, len(items), self.chunk_size)]
+        results = []
+        for chunk in self.pool.starmap(_read_chunk, chunks):
+            results.extend(chunk)
+        return results
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def create_reader(workers=0, chunk_size=8, **kwargs):
+    ''' Return a pool of readers if workers are configured, else a reader in this process.
+    Negative workers: one worker per core other than the one used by the crawler.
+    '''
+    if workers is not None and workers < 0:
+        workers = (os.cpu_count() or 1) - 1
+    if workers:
+        return ArticleReaderPool(workers, chunk_size, **kwargs)
+    else:
+        return ArticleReader(**kwargs)
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import time
+import aiohttp
+import mwclient
+from api_connector import ApiConnector
+from crawl_stats import stats
+from scheduler import ThrottledError
+
+
+class AsyncApiConnector(ApiConnector):
+    ''' Call an API asynchronously to request many articles at once.
+    Requests share a pool of keep-alive connections. The number of requests
+    in flight at any time is limited by configuration 'concurrency'.
+    Methods have the same names as in ApiConnector but are coroutines.
+    '''
+
+    user_agent = 'wikipedia-reader (https://github.com/DevopediaOrg/wikipedia-reader)'
+
+    def connect(self):
+        if 'concurrency' not in self.config or not self.config['concurrency']:
+            self.config['concurrency'] = 32
+        if 'timeout' not in self.config or not self.config['timeout']:
+            self.config['timeout'] = 60 # seconds
+
+        self.url = '{}://{}/w/api.php'.format(self.config['scheme'], self.config['endpoint'])
+
+        # Session is bound to the event loop, so keep one loop for the whole process
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.semaphore = None
+
+    def close(self):
+        if self.session is not None:
+            self.run(self.session.close())
+        self.loop.close()
+        super().close()
+
+    def run(self, coro):
+        ''' Run a coroutine to completion on the connector's event loop.
+        '''
+        return self.loop.run_until_complete(coro)
+
+    def open_session(self):
+        # Must be created from within the running loop
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.config['concurrency'], limit_per_host=self.config['concurrency'],
+                keepalive_timeout=30)
+            self.session = aiohttp.ClientSession(
+                connector=connector, headers={'User-Agent': self.user_agent},
+                timeout=aiohttp.ClientTimeout(total=self.config['timeout']))
+            self.semaphore = asyncio.Semaphore(self.config['concurrency'])
+        return self.session
+
+    async def call(self, action, **params):
+        content = self.lookup(action, params)
+        if content is None:
+            content = await self.request(action, **params)
+            self.store(action, params, content)
+
+        # Same exception as mwclient so that callers handle both backends alike
+        return self.check_response(content, params)
+
+    async def request(self, action, **params):
+        params.update(action=action, format='json', maxlag=self.config['maxlag'])
+        if action == 'query' and 'continue' not in params:
+            params['continue'] = ''
+
+        session = self.open_session()
+        async with self.semaphore:
+            start, body = time.perf_counter(), b''
+            try:
+                async with session.get(self.url, params=params) as resp:
+                    retry_after = ThrottledError.parse_retry_after(resp.headers.get('Retry-After'))
+                    if resp.status in (429, 503):
+                        raise ThrottledError(retry_after, 'HTTP {}'.format(resp.status))
+                    resp.raise_for_status()
+                    body = await resp.read()
+            finally:
+                stats.observe_call(action, time.perf_counter() - start, len(body))
+        content = json.loads(body)
+
+        if 'error' in content and content['error'].get('code') in ('maxlag', 'ratelimited'):
+            raise ThrottledError(retry_after, content['error']['code'])
+        return content
+
+    async def get_text(self, title):
+        content = await self.call('query', **self.text_params(title))
+        return self.read_text(title, content)
+
+    async def get_texts(self, titles):
+        params = self.texts_params(titles)
+
+        # Pages of a paginated response must be requested one after another
+        all_content = []
+        continues = {}
+        while True:
+            content = await self.call('query', **params, **continues)
+            all_content.append(content)
+            if 'continue' in content:
+                continues = content['continue']
+            else:
+                break
+
+        return self.read_texts(titles, all_content)
+
+    async def get_parsed_text(self, title):
+        targets = self.split_targets(title)
+
+        try:
+            content = await self.call('parse', **self.parse_params(title))
+        except mwclient.errors.APIError:
+            # one reason is that the page doesn't exist
+            return {
+                'title': title,
+                'text': ''
+            }
+
+        return self.read_parsed_text(content, targets)
+
+    async def get_info(self, titles, query=None):
+        params = self.info_params(titles, query)
+
+        # Pages of a paginated response must be requested one after another
+        all_content = []
+        continues = {}
+        while True:
+            content = await self.call('query', **params, **continues)
+            all_content.append(content)
+            if 'continue' in content:
+                continues = content['continue']
+            else:
+                break
+
+        return self.read_info(all_content)
+
+    async def get_lastrevids(self, titles):
+        return await self.get_info(titles, {'info': {}})
+
+    async def resolve_titles(self, titles):
+        content = await self.call('query', **self.resolve_params(titles))
+        return self.read_resolved(titles, content)
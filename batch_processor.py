@@ -1,9 +1,122 @@
+import asyncio
 import copy
-import concurrent.futures
+import os
+import pickle
+import queue
+import tempfile
+import threading
+import time
+import tracemalloc
+from crawl_stats import stats
+from data_saver import ArticleRecord
+from scheduler import AimdController, Scheduler
+
+
+class SpillQueue:
+    ''' Unbounded queue of articles that spills articles to a temporary file while memory
+    in use, as traced by tracemalloc, is over max_bytes. Spilled articles are read back
+    when they're taken from the queue. Fetching need not wait for a slow reader.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.file = None
+        self.num_spilled = 0
+        self.bytes_spilled = 0
+
+    def put(self, item):
+        if isinstance(item, ArticleRecord) and tracemalloc.get_traced_memory()[0] > self.max_bytes:
+            data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+            with self.lock:
+                if self.file is None:
+                    self.file = tempfile.TemporaryFile(prefix='spill.')
+                self.file.seek(0, os.SEEK_END)
+                item = ('spilled', self.file.tell(), len(data))
+                self.file.write(data)
+                self.num_spilled += 1
+                self.bytes_spilled += len(data)
+        self.queue.put(item)
+
+    def get(self):
+        return self.load(self.queue.get())
+
+    def get_nowait(self):
+        return self.load(self.queue.get_nowait())
+
+    def load(self, item):
+        if isinstance(item, tuple) and item[0] == 'spilled':
+            with self.lock:
+                self.file.seek(item[1])
+                item = pickle.loads(self.file.read(item[2]))
+        return item
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class MemoryMonitor:
+    ''' Peak memory in use, as traced by tracemalloc, while each stage of a batch runs.
+    Stages run at the same time, so the peak of the process since the last start() or end()
+    of any stage is counted for every stage running then, and the peak is reset.
+    Does nothing unless tracemalloc is tracing.
+    '''
+
+    def __init__(self):
+        # Peaks are reset when stages start and end: needs Python 3.9
+        self.tracing = tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+        self.peaks = {}
+        self.running = {} # number of each stage running
+        self.peak = 0
+        self.lock = threading.Lock()
+        if self.tracing:
+            tracemalloc.reset_peak()
+
+    def start(self, stage):
+        if self.tracing:
+            with self.lock:
+                self.collect()
+                self.running[stage] = self.running.get(stage, 0) + 1
+
+    def end(self, stage):
+        if self.tracing:
+            with self.lock:
+                self.collect()
+                self.running[stage] -= 1
+
+    def collect(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        self.peak = max(self.peak, peak)
+        for stage, num in self.running.items():
+            if num and peak > self.peaks.get(stage, 0):
+                self.peaks[stage] = peak
+
+    def report(self, spilled=None):
+        if not self.tracing:
+            return
+        with self.lock:
+            self.collect()
+        mb = 1024 * 1024
+        stages = ', '.join('{} {:.1f}'.format(k, v / mb) for k, v in self.peaks.items())
+        msg = "Memory peak {:.1f} MB (by stage: {})".format(self.peak / mb, stages)
+        if spilled is not None and spilled.num_spilled:
+            msg += ", spilled {} articles ({:.1f} MB)".format(spilled.num_spilled, spilled.bytes_spilled / mb)
+        print(msg, flush=True)
 
 
 class BatchProcessor:
-    ''' A class to process articles in batches.  
+    ''' A class to process articles in batches.
+    API calls are scheduled with adaptive concurrency: as many calls are in flight
+    as the server allows, up to configuration 'concurrency'. Failed calls are retried.
+    Blocking API functions are called from a pool of threads. Coroutine API functions
+    are called on the connector's event loop.
+    With batch_process(), articles are fetched, read and handed over in stages that run
+    at the same time, joined by queues of at most 'queue_size' items. Articles are kept
+    in compact records. With 'memory_limit' (bytes), fetched articles are spilled to disk
+    rather than queued in memory while the limit is exceeded, and HTML is dropped once read.
     '''
 
     def __init__(self, api_func, minibatch_size, reader, **kwargs):
@@ -11,10 +124,29 @@ class BatchProcessor:
         self.minibatch_size = minibatch_size
         self.reader = reader
         self.config = kwargs
+        if 'concurrency' not in self.config or not self.config['concurrency']:
+            self.config['concurrency'] = 4
+        if 'max_retries' not in self.config or not self.config['max_retries']:
+            self.config['max_retries'] = 5
+        if 'queue_size' not in self.config or not self.config['queue_size']:
+            self.config['queue_size'] = 64
+        if 'read_chunk' not in self.config or not self.config['read_chunk']:
+            self.config['read_chunk'] = 16
+        if 'memory_limit' not in self.config or not self.config['memory_limit']:
+            self.config['memory_limit'] = None
 
-    def batch_call_api(self, titles):
-        articles = []
+        # Learnt limit is kept across batches
+        self.controller = AimdController(initial=min(4, self.config['concurrency']),
+                                         maximum=self.config['concurrency'])
+        self.failed = []
 
+    def batch_call_api(self, titles, on_article=None, room=None, stop=None):
+        ''' Call the API for all titles. Titles that failed even after retries are
+        available in attribute 'failed' until the next call.
+        If on_article is given, it's called with each article as it arrives and
+        articles are not returned. Calls are started only while room() is true, if given,
+        and not once stop is set, if given.
+        '''
         # Mini-batch of minibatch_size titles in a single API call
         minis = []
         if self.minibatch_size > 1:
@@ -22,44 +154,156 @@ class BatchProcessor:
             for i in range(0, len(titles), self.minibatch_size):
                 minis.append(titles[i:i+self.minibatch_size])
         else:
-            minis = titles
+            minis = list(titles)
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-            futures = {executor.submit(self.api_func, mini): mini for mini in minis}
-            for i, future in enumerate(concurrent.futures.as_completed(futures), start=1):
-                mini = futures[future]
-                try:
-                    print("{}/{}: {}".format(i, len(minis), mini), flush=True)
-                    content = future.result()
-                    if isinstance(content, list):
-                        articles.extend(content)
-                    else:
-                        articles.append(content)
-                except Exception as exc:
-                    print('%r generated an exception: %s' % (mini, exc))
+        articles = []
+        num_done, num_articles = 0, 0
+        start = time.perf_counter()
+        def add_result(mini, content):
+            nonlocal num_done, num_articles
+            num_done += 1
+            print("{}/{}: {} (concurrency {})".format(
+                num_done, len(minis), mini if isinstance(mini, str) else '{} titles'.format(len(mini)),
+                self.controller.limit), flush=True)
+            contents = content if isinstance(content, list) else [content]
+            num_articles += len(contents)
+            if on_article is None:
+                articles.extend(contents)
+            else:
+                for article in contents: on_article(article)
+
+        scheduler = Scheduler(self.api_func, self.controller, self.config['max_retries'], room=room, stop=stop)
+        if asyncio.iscoroutinefunction(self.api_func):
+            self.api_func.__self__.run(scheduler.run_async(minis, add_result))
+        else:
+            scheduler.run_threads(minis, add_result)
+        stats.add_time('fetch', time.perf_counter() - start, num_articles)
+
+        self.failed = []
+        for mini in scheduler.failed:
+            if self.minibatch_size > 1:
+                self.failed.extend(mini)
+            else:
+                self.failed.append(mini)
 
         return articles
 
+    def batch_process(self, titles, on_read):
+        ''' Fetch and read articles of all titles, calling on_read(contents, links, transcludes, outlinks)
+        from this thread for each chunk of articles as soon as it's read.
+        Fetching and reading run in their own threads: the network isn't idle while articles
+        are read and saved. When a stage falls behind, earlier stages pause: no API call is
+        started while 'queue_size' fetched articles wait to be read, so that a full queue
+        never blocks the event loop. If on_read fails, calls not yet started are dropped and
+        the other stages are finished before the error is raised.
+        '''
+        memory_limit = self.config['memory_limit']
+        if memory_limit:
+            # Spilled to disk rather than waiting for room
+            fetched = SpillQueue(memory_limit)
+            room = None
+        else:
+            fetched = queue.Queue()
+            room = lambda: fetched.qsize() < self.config['queue_size']
+        read = queue.Queue(max(1, self.config['queue_size'] // self.config['read_chunk']))
+        done = object()
+        stop = threading.Event()
+        errors = []
+        monitor = MemoryMonitor()
+
+        def add_article(article):
+            fetched.put(ArticleRecord(article))
+
+        def fetch():
+            monitor.start('fetch')
+            try:
+                self.batch_call_api(titles, add_article, room, stop)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                monitor.end('fetch')
+                fetched.put(done)
+
+        def parse():
+            finished = False
+            try:
+                while not finished:
+                    # Wait for one article, then take whatever else is ready
+                    chunk = [fetched.get()]
+                    while len(chunk) < self.config['read_chunk'] and chunk[-1] is not done:
+                        try: chunk.append(fetched.get_nowait())
+                        except queue.Empty: break
+                    if chunk[-1] is done:
+                        finished = True
+                        chunk.pop()
+                    if chunk and not stop.is_set():
+                        monitor.start('read')
+                        try:
+                            contents, links, transcludes, outlinks = self.read_articles(chunk)
+                            if memory_limit:
+                                # HTML is needed only to read transcludes
+                                for article in contents: article.pop('html', None)
+                        finally:
+                            monitor.end('read')
+                        read.put((contents, links, transcludes, outlinks))
+            except BaseException as e:
+                errors.append(e)
+                while not finished: finished = fetched.get() is done # unblock fetcher
+            finally:
+                read.put(done)
+
+        # Daemon threads: a second Ctrl-C must be able to quit
+        threads = [threading.Thread(target=fetch, daemon=True), threading.Thread(target=parse, daemon=True)]
+        for thread in threads: thread.start()
+        item = None
+        try:
+            while True:
+                item = read.get()
+                if item is done: break
+                start = time.perf_counter()
+                monitor.start('save')
+                try:
+                    on_read(*item)
+                finally:
+                    monitor.end('save')
+                stats.add_time('save', time.perf_counter() - start, len(item[0]))
+        finally:
+            if item is not done:
+                # on_read failed: calls in flight finish, their articles are dropped
+                stop.set()
+                while read.get() is not done: pass
+            for thread in threads: thread.join()
+            if memory_limit: fetched.close()
+        monitor.report(fetched if memory_limit else None)
+        if errors:
+            raise errors[0]
 
     def read_articles(self, articles):
+        ''' Return articles that exist, links and transcludes found in them, and links and
+        transcludes of each article in the same order as articles. Sections found by the
+        reader are kept with each article.
+        '''
         all_content = []
         all_links = set()
         all_transcludes = set()
+        outlinks = []
 
+        # Only fields needed by parsers: these may be sent to worker processes
+        items = []
         for article in articles:
             # Empty text: article doesn't exist
             if 'text' not in article or not article['text'].strip(): continue
 
             targets = article['targets'] if 'targets' in article else []
-            if self.config['seed']:
-                all_links |=  self.reader.get_seed_links(article['text'], targets)
-            else:
-                links, transcludes = self.reader.get_links(article['title'], article['text'], article['html'])
-                all_links |=  links
-                all_transcludes |= transcludes
-
+            items.append((article['title'], article['text'], article.get('html'), targets))
             all_content.append(article)
 
-        return all_content, all_links, all_transcludes
-
+        start = time.perf_counter()
+        for article, (links, transcludes, sections) in zip(all_content, self.reader.read_many(self.config['seed'], items)):
+            all_links |= links
+            all_transcludes |= transcludes
+            outlinks.append((links, transcludes))
+            article['sections'] = sections
+        stats.add_time('parse', time.perf_counter() - start, len(items), sum(len(item[1]) for item in items))
 
+        return all_content, all_links, all_transcludes, outlinks
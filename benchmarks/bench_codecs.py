@@ -0,0 +1,101 @@
+''' Benchmark codecs of article files: articles are written with ArticleStreamSaver in chunks,
+as a crawl writes them, and read back one by one with ArticleStore. Reports MB per second
+of JSON written and read, and compression ratio, for each codec, level and number of threads.
+'''
+
+
+import argparse
+from datetime import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from fake_wiki import REPO_DIR, make_fixtures
+
+sys.path.insert(0, REPO_DIR)
+from data_saver import ArticleSaver, ArticleStore, ArticleStreamSaver, zstandard
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark codecs of article files.')
+    parser.add_argument('-f','--fixtures', default=None,
+        help='Fixtures file (JSON Lines) to use. If not given, fixtures are generated.')
+    parser.add_argument('--articles', default=None, metavar='PREFIX',
+        help='Use articles saved by a crawl, eg. output/week23/ac, rather than fixtures.')
+    parser.add_argument('--generate', default=500, type=int, metavar='N',
+        help='Number of articles to generate when no fixtures file is given. Default is 500.')
+    parser.add_argument('--size', default=20, type=int, metavar='KB',
+        help='Average wikitext size of generated articles. Default is 20 KB.')
+    parser.add_argument('--html', action='store_true', help='Include HTML of articles, as when transcludes are enabled.')
+    parser.add_argument('--threads', default=[1, 4], type=int, nargs='+', help='Numbers of threads to try. Default is 1 4.')
+    parser.add_argument('--chunk', default=16, type=int, help='Articles per write. Default is 16.')
+    parser.add_argument('--json', default=None, metavar='FILE', help='Append results to this JSON Lines file.')
+    return vars(parser.parse_args())
+
+
+def get_articles(args):
+    if args['articles']:
+        articles = list(ArticleSaver.read_content_files(args['articles']))
+    else:
+        fixtures = make_fixtures(args)
+        articles = [{'title': p['title'], 'pageid': p['pageid'], 'revid': p['revid'], 'text': p['wikitext'],
+                     'html': p.get('html')} for p in fixtures.pages.values() if p.get('wikitext')]
+    if not args['html']:
+        for article in articles: article.pop('html', None)
+    return articles
+
+
+def bench(articles, codec, level, threads, chunk):
+    ''' Return seconds to write and read all articles, and bytes written. '''
+    outdir = tempfile.mkdtemp(prefix='bench.')
+    prefix = os.path.join(outdir, 'ac')
+    writer = ArticleStreamSaver(prefix, codec=codec, level=level, threads=threads)
+    start = time.perf_counter()
+    for i in range(0, len(articles), chunk):
+        writer.write(articles[i:i+chunk])
+    write_secs = time.perf_counter() - start
+    writer.close()
+
+    store = ArticleStore(prefix)
+    start = time.perf_counter()
+    for article in articles:
+        if store.get_by_pageid(article['pageid']) is None:
+            sys.exit("ERR: Article {} not read back. Quitting...".format(article['pageid']))
+    read_secs = time.perf_counter() - start
+    shutil.rmtree(outdir)
+    return write_secs, read_secs, writer.bytes_written
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    articles = get_articles(args)
+    raw_bytes = sum(len(json.dumps(a, separators=(',', ':')).encode('utf-8')) + 1 for a in articles)
+    mb = raw_bytes / 1024 / 1024
+    print("{} articles, {:.1f} MB of JSON, {:.1f} KB each on average".format(len(articles), mb, raw_bytes / 1024 / len(articles)))
+
+    # Default level of each codec and a faster one
+    codecs = [('bz2', 9), ('bz2', 1), ('gzip', 6), ('gzip', 1), ('lzma', 6), ('lzma', 1)]
+    if zstandard is not None:
+        codecs += [('zstd', 3), ('zstd', 1), ('zstd', 10)]
+    else:
+        print("zstd is skipped: package zstandard is not installed")
+
+    results = {'date': datetime.now().isoformat(timespec='seconds'), 'articles': len(articles),
+               'mb': round(mb, 1), 'cpus': os.cpu_count()}
+    print("{:>10} {:>7} {:>12} {:>12} {:>7}".format('codec', 'threads', 'write MB/s', 'read MB/s', 'ratio'))
+    for codec, level in codecs:
+        for threads in args['threads']:
+            write_secs, read_secs, nbytes = bench(articles, codec, level, threads, args['chunk'])
+            name = '{}-{}'.format(codec, level)
+            results['{} x{}'.format(name, threads)] = {
+                'write_mb_per_sec': round(mb / write_secs, 1),
+                'read_mb_per_sec': round(mb / read_secs, 1),
+                'ratio': round(raw_bytes / nbytes, 2)
+            }
+            print("{:>10} {:>7} {:>12.1f} {:>12.1f} {:>7.2f}".format(name, threads, mb / write_secs, mb / read_secs, raw_bytes / nbytes))
+
+    if args['json']:
+        with open(args['json'], 'a') as outfile:
+            outfile.write(json.dumps(results) + '\n')
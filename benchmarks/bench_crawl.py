@@ -0,0 +1,148 @@
+''' Benchmark a crawl end to end: main.py against a local stand-in for the MediaWiki API.
+Seeds a new crawl, then times a crawl of up to maximum number of pages. Reports titles
+per second, API calls and bytes per article, parse time per article and peak memory (RSS).
+Same arguments and fixtures give the same crawl, so results of two commits can be compared.
+'''
+
+
+import argparse
+from datetime import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from fake_wiki import REPO_DIR, FakeWiki, make_fixtures
+
+sys.path.insert(0, REPO_DIR)
+from article_reader import ArticleReader
+from data_saver import ArticleSaver
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark a crawl against a local stand-in for the MediaWiki API.')
+    parser.add_argument('-f','--fixtures', default=None,
+        help='Fixtures file (JSON Lines) to serve. If not given, fixtures are generated.')
+    parser.add_argument('--generate', default=2000, type=int, metavar='N',
+        help='Number of articles to generate when no fixtures file is given. Default is 2000.')
+    parser.add_argument('--size', default=20, type=int, metavar='KB',
+        help='Average wikitext size of generated articles. Default is 20 KB.')
+    parser.add_argument('--seed-title', default='Outline of benchmarks', help='Title of the seed article.')
+    parser.add_argument('--latency', default=0.05, type=float, help='Seconds taken by each response. Default is 0.05.')
+    parser.add_argument('--jitter', default=0.02, type=float, help='Latency varies by up to this many seconds.')
+    parser.add_argument('--error-rate', default=0.0, type=float, help='Fraction of requests throttled with HTTP 429.')
+    parser.add_argument('--retry-after', default=1, type=int, help='Retry-After seconds of throttled requests.')
+    parser.add_argument('--backend', default=None, choices=('async', 'mwclient'), help='API backend. Default is as configured.')
+    parser.add_argument('--concurrency', default=None, type=int, help='Maximum API calls in flight. Default is as configured.')
+    parser.add_argument('--workers', default=None, type=int, help='Reader processes. Default is as configured.')
+    parser.add_argument('--transcludes', action='store_true', help='Get transcluded navboxes (and hence HTML).')
+    parser.add_argument('-m','--maxpages', default=500, type=int, help='Maximum number of pages to crawl. Default is 500.')
+    parser.add_argument('-l','--levels', default=2, type=int, help='Number of levels to crawl. Default is 2.')
+    parser.add_argument('-r','--restricted', action='store_true', help='Restricted parsing.')
+    parser.add_argument('--bulk', action='store_true', help='Get only wikitext, many articles per API call.')
+    parser.add_argument('--dump', action='store_true', help='Read articles from a dump of the fixtures rather than the API.')
+    parser.add_argument('--json', default=None, metavar='FILE', help='Append results to this JSON Lines file.')
+    parser.add_argument('--keep', action='store_true', help='Keep the crawl folder.')
+    return vars(parser.parse_args())
+
+
+def make_config(args, workdir, endpoint):
+    ''' Configuration of the repository, pointed at the local server. API cache is off. '''
+    with open(os.path.join(REPO_DIR, 'config.json'), 'r') as infile:
+        cfg = json.load(infile)
+    cfg['api'].update(endpoint=endpoint, scheme='http')
+    cfg['api']['cache']['enabled'] = False
+    if args['backend']: cfg['api']['backend'] = args['backend']
+    if args['dump']:
+        cfg['api']['backend'] = 'dump'
+        cfg['api']['dump']['file'], cfg['api']['dump']['index'] = args['dump']
+    if args['concurrency']: cfg['api']['concurrency'] = args['concurrency']
+    if args['workers'] is not None: cfg.setdefault('reader', {})['workers'] = args['workers']
+    cfg['transcludes']['enabled'] = args['transcludes']
+    cfg['filter']['common_word_file'] = os.path.join(REPO_DIR, cfg['filter']['common_word_file'])
+    cfg['seed'] = os.path.join(workdir, 'seed.txt')
+    with open(cfg['seed'], 'w', encoding='utf-8') as outfile:
+        outfile.write(args['seed_title'] + '\n')
+    with open(os.path.join(workdir, 'config.json'), 'w') as outfile:
+        json.dump(cfg, outfile, indent=4)
+    return cfg
+
+
+def run_main(workdir, options):
+    ''' Run main.py in workdir. Return seconds taken and peak RSS in MB of the process. '''
+    cmd = [sys.executable, os.path.join(REPO_DIR, 'main.py'), '-b', os.path.join(workdir, 'output'), '-d', 'bench']
+    with open(os.path.join(workdir, 'main.log'), 'a') as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd + options, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(proc.pid, 0)
+        secs = time.perf_counter() - start
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if proc.returncode != 0:
+        sys.exit("ERR: main.py {} failed. See {}. Quitting...".format(' '.join(options), os.path.join(workdir, 'main.log')))
+    # Kilobytes on Linux, bytes on macOS
+    rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return secs, rss
+
+
+def time_parsing(cfg, args, prefix):
+    ''' Return number of saved articles and milliseconds taken to read each of them. '''
+    reader = ArticleReader(transcludes=cfg['transcludes'], restricted=args['restricted'])
+    articles = list(ArticleSaver.read_content_files(prefix))
+    start = time.perf_counter()
+    for article in articles:
+        reader.read(False, article['title'], article['text'], article.get('html'), article.get('targets', []))
+    secs = time.perf_counter() - start
+    return len(articles), 1000 * secs / max(1, len(articles))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    fixtures = make_fixtures(args)
+    server = FakeWiki(fixtures, 0, args['latency'], args['jitter'], args['error_rate'], args['retry_after'])
+    server.start()
+    workdir = tempfile.mkdtemp(prefix='bench.')
+    if args['dump']:
+        args['dump'] = fixtures.save_dump(os.path.join(workdir, 'fakewiki'))
+    cfg = make_config(args, workdir, server.endpoint)
+    print("Serving {} pages at {}. Crawling in {}...".format(len(fixtures), server.endpoint, workdir))
+
+    # Seeding is not timed
+    run_main(workdir, ['-s', '-m', '1000'])
+    server.reset()
+
+    options = ['-m', str(args['maxpages']), '-l', str(args['levels'])]
+    if args['restricted']: options.append('-r')
+    if args['bulk']: options.append('--bulk')
+    secs, rss = run_main(workdir, options)
+    stats = dict(server.stats)
+    num_articles, parse_ms = time_parsing(cfg, args, os.path.join(workdir, 'output', 'bench', 'ac'))
+    server.shutdown()
+
+    results = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'options': ' '.join(options),
+        'backend': cfg['api']['backend'],
+        'latency': args['latency'],
+        'error_rate': args['error_rate'],
+        'articles': num_articles,
+        'seconds': round(secs, 2),
+        'titles_per_sec': round(num_articles / secs, 1),
+        'calls_per_article': round(stats['calls'] / max(1, num_articles), 2),
+        'throttled': stats['errors'],
+        'kb_per_article': round(stats['bytes_sent'] / 1024 / max(1, num_articles), 1),
+        'mb_transferred': round((stats['bytes_sent'] + stats['bytes_received']) / 1024 / 1024, 1),
+        'parse_ms_per_article': round(parse_ms, 2),
+        'peak_rss_mb': round(rss, 1),
+    }
+    for k, v in results.items():
+        print("{:>22}: {}".format(k, v))
+    if args['json']:
+        with open(args['json'], 'a') as outfile:
+            outfile.write(json.dumps(results) + '\n')
+
+    if args['keep']:
+        print("Crawl is kept in {}".format(workdir))
+    else:
+        shutil.rmtree(workdir)
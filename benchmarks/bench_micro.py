@@ -0,0 +1,97 @@
+''' Micro-benchmarks of parsing, filtering and saving, on the same fixtures as bench_crawl.py.
+Each benchmark is run a few times over all articles (or titles) and the best run is reported.
+'''
+
+
+import argparse
+from datetime import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from fake_wiki import REPO_DIR, make_fixtures
+
+sys.path.insert(0, REPO_DIR)
+from article_filter import ArticleFilter
+from data_saver import ArticleSaver
+from parsers import HtmlParser, WikitextParser
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of parsing, filtering and saving.')
+    parser.add_argument('-f','--fixtures', default=None,
+        help='Fixtures file (JSON Lines) to use. If not given, fixtures are generated.')
+    parser.add_argument('--generate', default=500, type=int, metavar='N',
+        help='Number of articles to generate when no fixtures file is given. Default is 500.')
+    parser.add_argument('--size', default=20, type=int, metavar='KB',
+        help='Average wikitext size of generated articles. Default is 20 KB.')
+    parser.add_argument('--repeat', default=5, type=int, help='Runs of each benchmark. Default is 5.')
+    parser.add_argument('--only', default=None, nargs='+', metavar='NAME', help='Run only these benchmarks.')
+    parser.add_argument('--json', default=None, metavar='FILE', help='Append results to this JSON Lines file.')
+    return vars(parser.parse_args())
+
+
+def bench(func, items, repeat):
+    ''' Return best seconds taken to call func once for every item. '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(*item)
+        secs = time.perf_counter() - start
+        best = secs if best is None else min(best, secs)
+    return best
+
+
+def make_benchmarks(pages):
+    ''' Return (name, function, argument tuples, unit) of each benchmark. '''
+    transcludes = {'enabled': True, 'add_to_curr_level': False}
+    wtparser = WikitextParser(transcludes=transcludes, restricted=False)
+    rwtparser = WikitextParser(transcludes=transcludes, restricted=True)
+    hparser = HtmlParser(transcludes=transcludes, restricted=False)
+    afilter = ArticleFilter(common_word_file=os.path.join(REPO_DIR, 'data', 'words.txt'))
+
+    texts = [(p['title'], p['wikitext']) for p in pages]
+    links = set()
+    for title, text in texts:
+        links |= wtparser.get_links(title, text)
+    # Namespaces and interwiki links are filtered too
+    titles = [(t,) for t in sorted(links)] + [(t,) for t in ('Category:Benchmarks', 'de:Benchmark', 'Template:Navbox')]
+
+    outdir = tempfile.mkdtemp(prefix='bench.')
+    articles = [{'title': p['title'], 'pageid': p['pageid'], 'revid': p['revid'], 'text': p['wikitext']} for p in pages]
+    chunks = [(os.path.join(outdir, 'ac'), articles[i:i+50]) for i in range(0, len(articles), 50)]
+
+    return [
+        ('WikitextParser.get_links', wtparser.get_links, texts, 'article'),
+        ('WikitextParser.get_links (restricted)', rwtparser.get_links, texts, 'article'),
+        ('WikitextParser.get_seed_links', wtparser.get_seed_links, [(t, None) for _, t in texts], 'article'),
+        ('HtmlParser.get_transcludes', hparser.get_transcludes, [(p['html'],) for p in pages if p.get('html')], 'article'),
+        ('ArticleFilter.is_allowed', afilter.is_allowed, titles, 'title'),
+        ('ArticleSaver.write_content_file', ArticleSaver.write_content_file, chunks, 'file of 50'),
+    ], outdir
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    fixtures = make_fixtures(args)
+    pages = [p for p in fixtures.pages.values() if p.get('wikitext')]
+    benchmarks, outdir = make_benchmarks(pages)
+    print("{} articles, {:.1f} KB of wikitext each on average".format(
+        len(pages), sum(len(p['wikitext']) for p in pages) / len(pages) / 1024))
+
+    results = {'date': datetime.now().isoformat(timespec='seconds'), 'articles': len(pages)}
+    for name, func, items, unit in benchmarks:
+        if args['only'] and not any(o in name for o in args['only']): continue
+        if not items: continue
+        secs = bench(func, items, args['repeat'])
+        usecs = 1e6 * secs / len(items)
+        results[name] = round(usecs, 2)
+        print("{:>40}: {:10.1f} us per {} ({} {}s)".format(name, usecs, unit, len(items), unit.split()[0]))
+    shutil.rmtree(outdir)
+
+    if args['json']:
+        with open(args['json'], 'a') as outfile:
+            outfile.write(json.dumps(results) + '\n')
@@ -0,0 +1,105 @@
+''' Check a crawl shared by many workers: main.py --worker I --workers N against a local
+stand-in for the MediaWiki API. Seeds a new crawl, runs the workers at the same time and
+checks that every level they started was finished: no title is left pending or leased,
+nothing is stranded outside the shared frontier and no page was saved twice.
+By default, transcluded titles are added to the current level (transcludes.add_to_curr_level),
+the case where titles are added to a level while it's being crawled.
+Exits with an error if any check fails.
+'''
+
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from fake_wiki import REPO_DIR, FakeWiki, make_fixtures
+from bench_crawl import make_config, run_main
+
+sys.path.insert(0, REPO_DIR)
+from data_saver import ArticleSaver
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check a crawl shared by many workers against a local stand-in for the MediaWiki API.')
+    parser.add_argument('-f','--fixtures', default=None,
+        help='Fixtures file (JSON Lines) to serve. If not given, fixtures are generated.')
+    parser.add_argument('--generate', default=2000, type=int, metavar='N',
+        help='Number of articles to generate when no fixtures file is given. Default is 2000.')
+    parser.add_argument('--size', default=5, type=int, metavar='KB',
+        help='Average wikitext size of generated articles. Default is 5 KB.')
+    parser.add_argument('--seed-title', default='Outline of benchmarks', help='Title of the seed article.')
+    parser.add_argument('--backend', default=None, choices=('async', 'mwclient'), help='API backend. Default is as configured.')
+    parser.add_argument('--shared', default=3, type=int, metavar='N', help='Number of workers sharing the crawl. Default is 3.')
+    parser.add_argument('-l','--levels', default=2, type=int, help='Number of levels to crawl. Default is 2.')
+    parser.add_argument('--next-level', action='store_true', help='Add transcluded titles to the next level instead.')
+    parser.add_argument('--keep', action='store_true', help='Keep the crawl folder.')
+    return vars(parser.parse_args())
+
+
+def check(db_file, prefix, levels):
+    ''' Return a list of problems found in the state and articles of a finished shared crawl. '''
+    db = sqlite3.connect(db_file)
+    count = lambda sql: db.execute(sql).fetchone()[0]
+    level = int(count("SELECT COALESCE(MAX(value), 1) FROM meta WHERE key='curr_level'"))
+    problems = []
+    num_pending = count("SELECT COUNT(*) FROM titles WHERE status='pending'")
+    if num_pending:
+        problems.append("{} titles of level {} are still pending".format(num_pending, level))
+    num_stranded = count("SELECT COUNT(*) FROM titles WHERE status='pending' AND title NOT IN (SELECT title FROM frontier)")
+    if num_stranded:
+        problems.append("{} pending titles are missing from the frontier".format(num_stranded))
+    num_leased = count('SELECT COUNT(*) FROM leases')
+    if num_leased:
+        problems.append("{} titles are still leased".format(num_leased))
+    if level < levels and count("SELECT COUNT(*) FROM titles WHERE status='next_pending'"):
+        problems.append("Crawl stopped at level {} of {} with titles of the next level".format(level, levels))
+
+    pageids = [a['pageid'] for a in ArticleSaver.read_content_files(prefix)]
+    if len(pageids) != len(set(pageids)):
+        problems.append("{} pages were saved more than once".format(len(pageids) - len(set(pageids))))
+    print("Level {}: {} articles, {} titles crawled".format(
+        level, len(pageids), count("SELECT COUNT(*) FROM titles WHERE status='crawled'")))
+    db.close()
+    return problems
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.update(dump=False, concurrency=None, workers=None, transcludes=True)
+    fixtures = make_fixtures(args)
+    server = FakeWiki(fixtures, 0)
+    server.start()
+    workdir = tempfile.mkdtemp(prefix='shared.')
+    cfg = make_config(args, workdir, server.endpoint)
+    cfg['transcludes']['add_to_curr_level'] = not args['next_level']
+    cfg.setdefault('coordination', {})['poll_secs'] = 1
+    with open(os.path.join(workdir, 'config.json'), 'w') as outfile:
+        json.dump(cfg, outfile, indent=4)
+    print("Serving {} pages at {}. Crawling with {} workers in {}...".format(
+        len(fixtures), server.endpoint, args['shared'], workdir))
+
+    run_main(workdir, ['-s', '-m', '1000'])
+    # Enough pages for all levels: each worker stops only when there's nothing left to claim
+    cmd = [sys.executable, os.path.join(REPO_DIR, 'main.py'), '-b', os.path.join(workdir, 'output'), '-d', 'bench',
+           '-m', '1000', '-l', str(args['levels']), '--workers', str(args['shared'])]
+    procs = []
+    for i in range(args['shared']):
+        with open(os.path.join(workdir, 'worker{}.log'.format(i)), 'w') as log:
+            procs.append(subprocess.Popen(cmd + ['--worker', str(i)], cwd=workdir, stdout=log, stderr=subprocess.STDOUT))
+    failed = [i for i, proc in enumerate(procs) if proc.wait() != 0]
+    server.shutdown()
+
+    outdir = os.path.join(workdir, 'output', 'bench')
+    problems = ["Worker {} failed. See {}".format(i, os.path.join(workdir, 'worker{}.log'.format(i))) for i in failed]
+    problems += check(os.path.join(outdir, 'crawl_state.db'), os.path.join(outdir, 'ac'), args['levels'])
+    if args['keep'] or problems:
+        print("Crawl is kept in {}".format(workdir))
+    else:
+        shutil.rmtree(workdir)
+    if problems:
+        sys.exit("ERR: {}. Quitting...".format('. '.join(problems)))
+    print("OK")
@@ -0,0 +1,403 @@
+''' A local stand-in for the MediaWiki API, for benchmarks.
+Pages are replayed from fixtures: a JSON Lines file with one page per line. Fixtures are
+either recorded from the API cache of a real crawl or generated. Responses of actions
+parse and query (prop revisions and info) are made from them, with configurable latency,
+jitter and rate of throttling errors. Counts of calls and bytes are at path /stats.
+'''
+
+
+import argparse
+import bz2
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape, quoteattr
+import zlib
+
+
+# Repository root: benchmarks are run from anywhere
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def normalize(title):
+    # Same as the API for namespace 0: eg. 'computer_science' -> 'Computer science'
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+
+class Fixtures:
+    ''' Pages keyed by title and redirects keyed by source title.
+    A page has title, pageid, revid, wikitext and html. A redirect has title and 'redirect'.
+    '''
+
+    def __init__(self, pages=(), redirects=None):
+        self.pages = {p['title']: p for p in pages}
+        self.redirects = dict(redirects or {})
+
+    def __len__(self):
+        return len(self.pages)
+
+    def resolve(self, title):
+        ''' Return (normalized title, redirect target or None, page or None). '''
+        name = normalize(title)
+        target = self.redirects.get(name)
+        return name, target, self.pages.get(target or name)
+
+    @classmethod
+    def load(cls, fname):
+        pages, redirects = [], {}
+        with open(fname, 'r', encoding='utf-8') as infile:
+            for line in infile:
+                item = json.loads(line)
+                if 'redirect' in item:
+                    redirects[item['title']] = item['redirect']
+                else:
+                    pages.append(item)
+        return cls(pages, redirects)
+
+    def save(self, fname):
+        with open(fname, 'w', encoding='utf-8') as outfile:
+            for page in self.pages.values():
+                outfile.write(json.dumps(page) + '\n')
+            for title, target in self.redirects.items():
+                outfile.write(json.dumps({'title': title, 'redirect': target}) + '\n')
+
+    def save_dump(self, prefix, pages_per_stream=100):
+        ''' Save as a multistream XML dump with its index, as Wikimedia publishes them.
+        Returns names of the dump and index files.
+        '''
+        fname = prefix + '-pages-articles-multistream.xml.bz2'
+        index_fname = prefix + '-pages-articles-multistream-index.txt.bz2'
+        pages = [(p['title'], p['pageid'], p['revid'], None, p['wikitext']) for p in self.pages.values()]
+        next_id = max([p[1] for p in pages] + [0]) + 1
+        for i, (title, target) in enumerate(sorted(self.redirects.items())):
+            pages.append((title, next_id + i, next_id + i, target, '#REDIRECT [[{}]]'.format(target)))
+
+        with open(fname, 'wb') as dumpfile, bz2.open(index_fname, 'wt', encoding='utf-8') as indexfile:
+            dumpfile.write(bz2.compress(b'<mediawiki xml:lang="en">\n  <siteinfo><sitename>Fake Wiki</sitename></siteinfo>\n'))
+            for i in range(0, len(pages), pages_per_stream):
+                offset = dumpfile.tell()
+                xml = []
+                for title, pageid, revid, target, text in pages[i:i+pages_per_stream]:
+                    indexfile.write('{}:{}:{}\n'.format(offset, pageid, title))
+                    xml.append('  <page>\n    <title>{}</title>\n    <ns>0</ns>\n    <id>{}</id>\n'.format(escape(title), pageid))
+                    if target: xml.append('    <redirect title={} />\n'.format(quoteattr(target)))
+                    xml.append('    <revision>\n      <id>{}</id>\n      <text bytes="{}" xml:space="preserve">{}</text>\n'
+                               '    </revision>\n  </page>\n'.format(revid, len(text.encode('utf-8')), escape(text)))
+                dumpfile.write(bz2.compress(''.join(xml).encode('utf-8')))
+            dumpfile.write(bz2.compress(b'</mediawiki>\n'))
+        return fname, index_fname
+
+    @classmethod
+    def record(cls, cache_file):
+        ''' Make fixtures from responses in the API cache of a real crawl. '''
+        db = sqlite3.connect(cache_file)
+        pages, redirects = {}, {}
+        for action, body in db.execute('SELECT action, body FROM responses'):
+            content = json.loads(zlib.decompress(body).decode('utf-8'))
+            if action == 'parse' and 'parse' in content:
+                pg = content['parse']
+                page = pages.setdefault(pg['title'], {'title': pg['title']})
+                page.update(pageid=pg['pageid'], revid=pg.get('revid', page.get('revid', 0)))
+                if 'wikitext' in pg: page['wikitext'] = pg['wikitext']['*']
+                if 'text' in pg: page['html'] = pg['text']['*']
+                for rdt in pg.get('redirects', []):
+                    redirects[rdt['from']] = rdt['to']
+            elif action == 'query' and 'query' in content:
+                for rdt in content['query'].get('redirects', []):
+                    redirects[rdt['from']] = rdt['to']
+                for pg in content['query'].get('pages', {}).values():
+                    if 'missing' in pg or not pg.get('revisions'): continue
+                    rev = pg['revisions'][0]
+                    text = rev['slots']['main']['*'] if 'slots' in rev else rev.get('*')
+                    if text is None: continue
+                    page = pages.setdefault(pg['title'], {'title': pg['title']})
+                    page.update(pageid=pg['pageid'], wikitext=text)
+                    if 'revid' in rev: page['revid'] = rev['revid']
+        db.close()
+        return cls([p for p in pages.values() if 'wikitext' in p], redirects)
+
+    @classmethod
+    def generate(cls, num_pages=2000, size_kb=20, seed=0, word_file=os.path.join(REPO_DIR, 'data', 'words.txt')):
+        ''' Make fixtures of articles that link to one another like Wikipedia articles do:
+        links in paragraphs, hatnotes, navboxes and See also sections, some to missing pages
+        and redirects. Seed page 'Outline of benchmarks' lists the first 10% of articles.
+        Same arguments give the same fixtures.
+        '''
+        rnd = random.Random(seed)
+        try:
+            with open(word_file, 'r', encoding='utf-8') as infile:
+                words = sorted(set(w.strip().lower() for w in infile if w.strip().isalpha()))
+        except FileNotFoundError:
+            words = ['alpha', 'beta', 'gamma', 'delta', 'system', 'network', 'theory', 'data']
+        titles, seen = [], set()
+        for i in range(num_pages):
+            title = '{} {}'.format(rnd.choice(words).capitalize(), rnd.choice(words))
+            titles.append(title if title not in seen else '{} {}'.format(title, i))
+            seen.add(titles[-1])
+        missing = ['{} {} {}'.format(rnd.choice(words).capitalize(), rnd.choice(words), i) for i in range(num_pages // 10)]
+        redirects = {'{} (redirect)'.format(t): t for t in rnd.sample(titles, num_pages // 20)}
+        targets = titles + missing + list(redirects)
+
+        def para():
+            out = []
+            for _ in range(rnd.randint(40, 80)):
+                if rnd.random() < 0.08:
+                    link = rnd.choice(targets)
+                    out.append('[[{}|{}]]'.format(link, link.lower()) if rnd.random() < 0.3 else '[[{}]]'.format(link))
+                else:
+                    out.append(rnd.choice(words))
+            return ' '.join(out) + '.\n'
+
+        pages = []
+        for i, title in enumerate(titles):
+            navbox = rnd.sample(titles, 15)
+            wikitext = ["{{{{Short description|{}}}}}\n{{{{Main|{}}}}}\n'''{}''' is a topic.\n".format(
+                title.lower(), rnd.choice(titles), title)]
+            size, num_sections = 0, 0
+            while size < size_kb * 1024 * rnd.uniform(0.5, 1.5):
+                if rnd.random() < 0.2:
+                    num_sections += 1
+                    wikitext.append('\n== Section {} ==\n'.format(num_sections))
+                    if rnd.random() < 0.3: wikitext.append('{{{{See also|{}}}}}\n'.format(rnd.choice(targets)))
+                wikitext.append(para())
+                size += len(wikitext[-1])
+            wikitext.append('\n== See also ==\n' + ''.join('* [[{}]]\n'.format(t) for t in rnd.sample(targets, 5)))
+            wikitext.append('\n== References ==\n{{Reflist}}\n{{Navbox benchmarks}}\n[[Category:Benchmarks]]\n')
+            wikitext = ''.join(wikitext)
+
+            # HTML is several times larger than wikitext, mostly markup and references
+            html = ['<div class="mw-parser-output">']
+            for line in wikitext.split('\n'):
+                html.append('<p>{}</p>'.format(line))
+            html.append('<div class="reflist"><ol class="references">')
+            html.extend('<li id="cite_note-{0}"><span class="mw-cite-backlink"><a href="#cite_ref-{0}">^</a></span> '
+                        '<span class="reference-text"><cite class="citation web cs1"><a rel="nofollow" class="external text" '
+                        'href="https://example.org/{1}/{0}">{1}</a>. <i>Example</i>. Retrieved 2020.</cite></span></li>'.format(
+                            n, rnd.choice(words)) for n in range(len(wikitext) // 100))
+            html.append('</ol></div>')
+            html.append('<div role="navigation" class="navbox" aria-labelledby="Bench"><table class="nowraplinks">')
+            html.extend('<tr><td class="navbox-list"><a href="/wiki/{}" title="{}">{}</a></td></tr>'.format(
+                t.replace(' ', '_'), t, t) for t in navbox)
+            html.append('</table></div></div>')
+            pages.append({'title': title, 'pageid': i + 1, 'revid': 100000 + i, 'wikitext': wikitext, 'html': ''.join(html)})
+
+        seed_text = "Outline of benchmarks.\n\n== Articles ==\n" + ''.join(
+            '* [[{}]]\n'.format(t) for t in titles[:max(1, num_pages // 10)]) + '\n== Other ==\n'
+        pages.append({'title': 'Outline of benchmarks', 'pageid': num_pages + 1, 'revid': 1,
+                      'wikitext': seed_text, 'html': '<div class="mw-parser-output"></div>'})
+        return cls(pages, redirects)
+
+
+class FakeWiki(ThreadingHTTPServer):
+    ''' HTTP server that answers API requests from fixtures.
+    A fraction error_rate of requests is throttled with HTTP 429 and a Retry-After delay.
+    '''
+
+    daemon_threads = True
+    max_result = 8 * 1024 * 1024 # API's limit on size of content in a response
+
+    def __init__(self, fixtures, port=0, latency=0.0, jitter=0.0, error_rate=0.0, retry_after=1, seed=0):
+        super().__init__(('127.0.0.1', port), FakeWikiHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def handle_error(self, request, client_address):
+        # Clients drop keep-alive connections when they quit
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def endpoint(self):
+        return '127.0.0.1:{}'.format(self.server_address[1])
+
+    def reset(self):
+        with self.lock:
+            self.stats = {'calls': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0, 'actions': {}}
+
+    def count(self, action, received, sent, error=False):
+        with self.lock:
+            self.stats['calls'] += 1
+            self.stats['errors'] += int(error)
+            self.stats['bytes_received'] += received
+            self.stats['bytes_sent'] += sent
+            self.stats['actions'][action] = self.stats['actions'].get(action, 0) + 1
+
+    def delay(self):
+        with self.lock:
+            throttle = self.random.random() < self.error_rate
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        return throttle, delay
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def parse(self, params):
+        name, target, page = self.fixtures.resolve(params.get('page', ''))
+        if page is None or (target and not params.get('redirects')):
+            return {'error': {'code': 'missingtitle', 'info': "The page you specified doesn't exist."}}
+        props = params.get('prop', '').split('|')
+        out = {'title': page['title'], 'pageid': page['pageid'],
+               'redirects': [{'from': name, 'to': target}] if target else []}
+        if 'revid' in props: out['revid'] = page['revid']
+        if 'displaytitle' in props: out['displaytitle'] = page['title']
+        if 'text' in props: out['text'] = {'*': page.get('html', '')}
+        if 'wikitext' in props: out['wikitext'] = {'*': page['wikitext']}
+        return {'parse': out}
+
+    def query(self, params):
+        if 'siteinfo' in params.get('meta', ''):
+            # Enough for mwclient to connect
+            return {'query': {'general': {'generator': 'MediaWiki 1.35.0', 'sitename': 'FakeWiki'},
+                              'namespaces': {'0': {'id': 0, '*': ''}},
+                              'userinfo': {'id': 0, 'name': '127.0.0.1', 'anon': ''}}}
+
+        props = params.get('prop', '').split('|')
+        titles = [t for t in params.get('titles', '').split('|') if t]
+        start, used, cont = int(params.get('rvcontinue', 0)), 0, None
+        query = {'pages': {}}
+        for i, title in enumerate(titles):
+            name, target, page = self.fixtures.resolve(title)
+            if name != title:
+                query.setdefault('normalized', []).append({'from': title, 'to': name})
+            if target and params.get('redirects'):
+                query.setdefault('redirects', []).append({'from': name, 'to': target})
+            elif target:
+                page = None
+            if page is None:
+                query['pages'][str(-1 - i)] = {'ns': 0, 'title': target or name, 'missing': ''}
+                continue
+            pg = {'pageid': page['pageid'], 'ns': 0, 'title': page['title']}
+            if 'info' in props:
+                pg.update(lastrevid=page['revid'], length=len(page['wikitext']), contentmodel='wikitext')
+            if 'revisions' in props and i >= start and cont is None:
+                # Paginate like the API: content that doesn't fit is in the next response
+                if used and used + len(page['wikitext']) > self.max_result:
+                    cont = i
+                else:
+                    used += len(page['wikitext'])
+                    pg['revisions'] = [{'revid': page['revid'], 'parentid': page['revid'] - 1,
+                                        'slots': {'main': {'contentmodel': 'wikitext', '*': page['wikitext']}}}]
+            query['pages'][str(page['pageid'])] = pg
+        if cont is not None:
+            return {'continue': {'rvcontinue': str(cont), 'continue': '||'}, 'query': query}
+        return {'batchcomplete': '', 'query': query}
+
+
+class FakeWikiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, as with the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, content, status=200, headers=None):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def do_GET(self):
+        self.answer(urlparse(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.answer(self.rfile.read(length).decode('utf-8'))
+
+    def answer(self, query):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            self.send(server.stats)
+            return
+
+        params = {k: v[0] for k, v in parse_qs(query, keep_blank_values=True).items()}
+        action = params.get('action', '')
+        throttle, delay = server.delay()
+        time.sleep(delay)
+        if throttle:
+            sent = self.send({'error': {'code': 'ratelimited', 'info': 'Slow down'}}, 429,
+                             {'Retry-After': str(server.retry_after)})
+            server.count(action, len(self.path) + len(query), sent, error=True)
+            return
+
+        if action == 'parse':
+            content = server.parse(params)
+        elif action == 'query':
+            content = server.query(params)
+        else:
+            content = {'error': {'code': 'badvalue', 'info': 'Unknown action {}'.format(action)}}
+        sent = self.send(content)
+        server.count(action, len(self.path) + len(query), sent)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the MediaWiki API from fixtures.')
+    parser.add_argument('-p','--port', default=8765, type=int, help='Port to listen on. Default is 8765.')
+    parser.add_argument('-f','--fixtures', default=None,
+        help='Fixtures file (JSON Lines) to serve. If not given, fixtures are generated.')
+    parser.add_argument('--generate', default=2000, type=int, metavar='N',
+        help='Number of articles to generate when no fixtures file is given. Default is 2000.')
+    parser.add_argument('--size', default=20, type=int, metavar='KB',
+        help='Average wikitext size of generated articles. Default is 20 KB.')
+    parser.add_argument('--record', default=None, metavar='CACHE',
+        help='Make fixtures from this API cache of a real crawl, save them into the fixtures file and quit.')
+    parser.add_argument('--save', default=None, metavar='FILE', help='Save generated fixtures into this file and quit.')
+    parser.add_argument('--dump', default=None, metavar='PREFIX',
+        help='Save fixtures as a multistream XML dump with its index, named from this prefix, and quit.')
+    parser.add_argument('--latency', default=0.05, type=float, help='Seconds taken by each response. Default is 0.05.')
+    parser.add_argument('--jitter', default=0.02, type=float, help='Latency varies by up to this many seconds.')
+    parser.add_argument('--error-rate', default=0.0, type=float, help='Fraction of requests throttled with HTTP 429.')
+    parser.add_argument('--retry-after', default=1, type=int, help='Retry-After seconds of throttled requests.')
+    return vars(parser.parse_args())
+
+
+def make_fixtures(args):
+    if args['fixtures'] and os.path.exists(args['fixtures']):
+        return Fixtures.load(args['fixtures'])
+    return Fixtures.generate(args['generate'], args['size'])
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args['record']:
+        if not args['fixtures']:
+            sys.exit("ERR: Fixtures file to save into is missing. Quitting...")
+        fixtures = Fixtures.record(args['record'])
+        fixtures.save(args['fixtures'])
+        print("Saved {} pages and {} redirects into {}".format(len(fixtures), len(fixtures.redirects), args['fixtures']))
+        sys.exit()
+
+    fixtures = make_fixtures(args)
+    if args['dump']:
+        print("Saved {} pages into {} and {}".format(len(fixtures), *fixtures.save_dump(args['dump'])))
+        sys.exit()
+    if args['save']:
+        fixtures.save(args['save'])
+        print("Saved {} pages into {}".format(len(fixtures), args['save']))
+        sys.exit()
+
+    server = FakeWiki(fixtures, args['port'], args['latency'], args['jitter'], args['error_rate'], args['retry_after'])
+    print("Serving {} pages at http://{}/w/api.php".format(len(fixtures), server.endpoint))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
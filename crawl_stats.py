@@ -0,0 +1,161 @@
+''' Instrumentation of a crawl: what's measured in any module is collected into 'stats'.
+'''
+
+
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json
+import os
+import threading
+
+
+class CrawlStats:
+    ''' Counters, time taken by each stage, latency histograms of API calls by action
+    and sizes of the frontier by level. Safe to update from many threads.
+    Saved as JSON with save(). Also served in Prometheus text format by serve().
+    '''
+
+    # Upper bounds in seconds of latency buckets
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    prefix = 'wikireader_'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = datetime.now().isoformat(timespec='seconds')
+            self.counters = {}
+            self.stages = {}
+            self.api = {}
+            self.frontier = {}
+
+    def count(self, name, num=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + num
+
+    def set_count(self, name, num):
+        ''' Set a counter that's kept elsewhere, such as hits of the API cache. '''
+        with self.lock:
+            self.counters[name] = num
+
+    def add_time(self, stage, secs, items=1, nbytes=0):
+        ''' Add time taken by a stage to process some items (articles, calls, ...). '''
+        with self.lock:
+            st = self.stages.setdefault(stage, {'seconds': 0.0, 'items': 0, 'bytes': 0})
+            st['seconds'] += secs
+            st['items'] += items
+            st['bytes'] += nbytes
+
+    def observe_call(self, action, secs, nbytes=0):
+        ''' Add an API call that was made over the network. '''
+        with self.lock:
+            api = self.api.get(action)
+            if api is None:
+                api = self.api[action] = {'calls': 0, 'seconds': 0.0, 'bytes': 0,
+                                          'buckets': [0] * (len(self.buckets) + 1)}
+            api['calls'] += 1
+            api['seconds'] += secs
+            api['bytes'] += nbytes
+            for i, bound in enumerate(self.buckets):
+                if secs <= bound: break
+            else:
+                i = len(self.buckets)
+            api['buckets'][i] += 1
+
+    def set_frontier(self, level, sizes):
+        ''' Sizes of sets of titles by status, at a level. '''
+        with self.lock:
+            self.frontier[str(level)] = dict(sizes)
+
+    def to_dict(self):
+        with self.lock:
+            api = {}
+            for action, v in self.api.items():
+                # Cumulative counts, as in Prometheus
+                cum, hist = 0, {}
+                for bound, num in zip(self.buckets + ('+Inf',), v['buckets']):
+                    cum += num
+                    hist[str(bound)] = cum
+                api[action] = {'calls': v['calls'], 'seconds': round(v['seconds'], 3), 'bytes': v['bytes'],
+                               'mean_ms': round(1000 * v['seconds'] / v['calls'], 1), 'latency_le': hist}
+            stages = {}
+            for stage, v in self.stages.items():
+                stages[stage] = dict(v, seconds=round(v['seconds'], 3),
+                                     ms_per_item=round(1000 * v['seconds'] / max(1, v['items']), 3))
+            return {
+                'started': self.started,
+                'updated': datetime.now().isoformat(timespec='seconds'),
+                'counters': dict(self.counters),
+                'stages': stages,
+                'api': api,
+                'frontier': {k: dict(v) for k, v in self.frontier.items()}
+            }
+
+    def save(self, fname):
+        # Replaced in one step: a reader never sees a partial file
+        tmpname = fname + '.tmp'
+        with open(tmpname, 'w', encoding='utf-8') as outfile:
+            json.dump(self.to_dict(), outfile, indent=2)
+        os.replace(tmpname, fname)
+
+    def to_prometheus(self):
+        ''' Return stats in Prometheus text exposition format. '''
+        stats = self.to_dict()
+        p = self.prefix
+        lines = []
+        for name, value in sorted(stats['counters'].items()):
+            lines.append('# TYPE {}{}_total counter'.format(p, name))
+            lines.append('{}{}_total {}'.format(p, name, value))
+
+        lines.append('# TYPE {}stage_seconds_total counter'.format(p))
+        lines.extend('{}stage_seconds_total{{stage="{}"}} {}'.format(p, s, v['seconds']) for s, v in stats['stages'].items())
+        lines.append('# TYPE {}stage_items_total counter'.format(p))
+        lines.extend('{}stage_items_total{{stage="{}"}} {}'.format(p, s, v['items']) for s, v in stats['stages'].items())
+        lines.append('# TYPE {}stage_bytes_total counter'.format(p))
+        lines.extend('{}stage_bytes_total{{stage="{}"}} {}'.format(p, s, v['bytes']) for s, v in stats['stages'].items())
+
+        lines.append('# TYPE {}api_latency_seconds histogram'.format(p))
+        for action, v in stats['api'].items():
+            for bound, num in v['latency_le'].items():
+                lines.append('{}api_latency_seconds_bucket{{action="{}",le="{}"}} {}'.format(p, action, bound, num))
+            lines.append('{}api_latency_seconds_sum{{action="{}"}} {}'.format(p, action, v['seconds']))
+            lines.append('{}api_latency_seconds_count{{action="{}"}} {}'.format(p, action, v['calls']))
+        lines.append('# TYPE {}api_response_bytes_total counter'.format(p))
+        lines.extend('{}api_response_bytes_total{{action="{}"}} {}'.format(p, a, v['bytes']) for a, v in stats['api'].items())
+
+        lines.append('# TYPE {}frontier_titles gauge'.format(p))
+        for level, sizes in stats['frontier'].items():
+            lines.extend('{}frontier_titles{{level="{}",status="{}"}} {}'.format(p, level, s, n) for s, n in sizes.items())
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        ''' Serve stats at http://{host}:{port}/metrics from a background thread.
+        Only this host can reach them by default: use host '0.0.0.0' to serve them on all interfaces.
+        '''
+        stats = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = stats.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# Shared by all modules of a crawl
+stats = CrawlStats()
@@ -0,0 +1,452 @@
+from collections import Counter
+from datetime import datetime
+import os
+import time
+import tracemalloc
+import utils
+from api_connector import create_connector
+from article_reader import create_reader
+from batch_processor import BatchProcessor
+from crawl_stats import stats
+from data_saver import ArticleSaver, ArticleStreamSaver, TitleSaver
+from link_graph import LinkGraph
+from article_filter import ArticleFilter
+from priority import TitlePriority
+from state_store import SharedFrontier, StateStore
+
+
+class Crawler:
+    ''' Crawl articles level by level, keeping the state of the crawl in a StateStore.
+    API connection, parsers, filters and crawl state are set up once. Hence crawl()
+    can be called many times by the same process, as in daemon mode.
+    '''
+
+    def __init__(self, args, cfg):
+        self.args = args
+        self.cfg = cfg
+        if args.get('memory_limit'):
+            # Slows down the crawl but memory in use is known
+            tracemalloc.start()
+        self.afilter = ArticleFilter(**cfg['filter'])
+
+        # Crawl state from previous crawls: migrated from text files of older crawls
+        self.store = StateStore(cfg['files']['state'])
+        self.store.migrate(cfg['files'])
+
+        # Workers of a shared crawl claim titles from a frontier that all of them share
+        self.frontier = None
+        if args.get('workers'):
+            ccfg = cfg.get('coordination', {})
+            self.frontier = SharedFrontier(self.store, args['worker'], args['workers'], ccfg.get('lease_secs') or 600)
+
+        # Current level: relevant only when not seeding
+        self.curr_level = self.store.level = int(self.store.get_meta('curr_level', 1))
+
+        # Sets of titles are views of the store: only what's needed is read
+        self.all_discards = self.store.titles('discarded')
+        self.all_redirects = self.store.titles('redirected')
+        self.all_titles = self.store.titles('crawled')
+        self.all_ids = self.store.pageids
+        self.all_pending = self.store.titles('pending')
+        self.all_next_pending = self.store.titles('next_pending')
+        self.all_batch = self.store.titles('batch')
+        self.all_revids = self.store.revids
+        if not self.all_revids and self.all_ids:
+            # Crawled before revisions were tracked: get them from saved articles
+            for content in ArticleSaver.read_content_files(cfg['files']['article_content_prefix']):
+                if 'revid' in content: self.all_revids[str(content['pageid'])] = content['revid']
+        self.recover()
+        self.priority = TitlePriority(self.store, cfg.get('frontier', {}).get('priority'))
+        if args.get('daemon') and self.frontier is None:
+            # Most links found are new: a filter skips most lookups of them
+            print("Loading filter of seen titles...")
+            self.store.use_filter()
+
+        # Are we seeding or crawling articles?
+        if args['seed']:
+            self.context = 'seed'
+            fields = os.path.split(cfg['files']['article_content_prefix'])
+            cfg['files']['article_content_prefix'] = os.path.join(*fields[:-1], 'seed.{}'.format(fields[-1]))
+        else:
+            self.context = 'article'
+        if self.frontier is not None:
+            # Each worker writes its own files
+            cfg['files']['article_content_prefix'] += '_w{}'.format(args['worker'])
+            cfg['files']['graph'] += '_w{}'.format(args['worker'])
+
+        # Links of each article are kept: the graph need not be rebuilt by parsing articles again
+        self.graph = None
+        gcfg = cfg.get('graph', {})
+        if gcfg.get('enabled', True):
+            self.graph = LinkGraph(cfg['files']['graph'], gcfg.get('max_segments'))
+
+        # Parsing workers are started before connecting: no threads or loops to copy
+        rcfg = cfg.get('reader', {})
+        self.areader = create_reader(workers=rcfg.get('workers'), chunk_size=rcfg.get('chunk_size'),
+            transcludes=cfg['transcludes'], restricted=args['restricted'])
+
+        # Connect once: connection pool and site handshake are reused by all batches
+        self.api = create_connector(**cfg['api'])
+        self.bulk = cfg['api'].get('func') == 'get_texts'
+        minibatch_size = self.api.bulk_size if self.bulk else 1
+        self.bproc = BatchProcessor(self.api.func, minibatch_size, self.areader, seed=args['seed'],
+            concurrency=cfg['api'].get('concurrency'), max_retries=cfg['api'].get('max_retries'),
+            queue_size=rcfg.get('queue_size'), read_chunk=rcfg.get('read_chunk'),
+            memory_limit=args['memory_limit'] * 1024 * 1024 if args.get('memory_limit') else None)
+        self.writer = None
+        self.all_failed = set()
+
+        # Titles are resolved cheaply before they're fetched: not when seeding or replaying
+        self.triage_titles = cfg['api'].get('triage', True) and not args['seed'] and \
+            not cfg['api'].get('cache', {}).get('replay') and not self.api.is_local
+        self.iproc = BatchProcessor(self.api.resolve_titles, 50, self.areader, seed=False,
+            concurrency=cfg['api'].get('concurrency'), max_retries=cfg['api'].get('max_retries'))
+        self.triaged_redirects = {}
+
+        # Stats of each run are kept in their own file
+        self.stats_file = '{}.{}{}.json'.format(cfg['files']['stats'], datetime.now().strftime('%Y%m%d.%H%M%S'),
+            '.w{}'.format(args['worker']) if self.frontier is not None else '')
+        if args.get('metrics_port'):
+            host = args.get('metrics_host') or '127.0.0.1'
+            stats.serve(args['metrics_port'], host)
+            print("Serving metrics at http://{}:{}/metrics".format(host, args['metrics_port']))
+
+    def recover(self):
+        ''' Recover from a crash: titles of the unfinished batch were not crawled. '''
+        if self.all_batch:
+            print("Recovering {} titles of an unfinished batch...".format(len(self.all_batch)))
+            self.all_titles -= self.all_batch
+            if self.store.get_meta('batch_context') == 'article': self.all_pending |= self.all_batch
+            self.all_batch.clear()
+        self.store.commit()
+
+    def refresh(self):
+        ''' Get again only articles that have changed since crawled. '''
+        args, cfg = self.args, self.cfg
+
+        # Up to 50 titles per call: these calls are cheap compared to parsing
+        iproc = BatchProcessor(self.api.get_lastrevids, 50, self.areader, seed=False,
+            concurrency=cfg['api'].get('concurrency'), max_retries=cfg['api'].get('max_retries'))
+        check_titles = self.all_titles - TitleSaver.read_title_file(cfg['seed'])
+        print("Checking {} crawled titles for changes...".format(len(check_titles)))
+        changed_titles = set()
+        for info in iproc.batch_call_api(check_titles):
+            if 'missing' in info or 'lastrevid' not in info: continue
+            if self.all_revids.get(str(info['pageid'])) != info['lastrevid']:
+                changed_titles.add(info['title'])
+
+        print("Found {} changed articles.".format(len(changed_titles)))
+        if len(changed_titles) > args['maxpages']:
+            # Rest will be found again in the next refresh
+            print("Refreshing only {} of them...".format(args['maxpages']))
+            changed_titles = set(sorted(changed_titles)[:args['maxpages']])
+
+        articles = self.bproc.batch_call_api(changed_titles)
+        contents, next_titles, trans_titles, outlinks = self.bproc.read_articles(articles)
+        for content, (links, transcludes) in zip(contents, outlinks):
+            if 'revid' in content: self.all_revids[str(content['pageid'])] = content['revid']
+            if self.graph is not None:
+                # Links may have changed but not the level
+                level = self.graph.level(content['title'])
+                self.graph.add(content['title'], self.curr_level if level is None else level, links, transcludes)
+
+        # Closed by close(), as for a crawl
+        if self.writer is None:
+            self.writer = ArticleStreamSaver(cfg['files']['article_content_prefix'], **cfg['output'])
+        self.writer.write(contents)
+        self.flush_graph()
+        self.store.commit()
+        stats.count('articles_refreshed', len(contents))
+
+    def crawl(self):
+        ''' Crawl up to maximum number of pages, saving state after every batch.
+        Returns number of articles saved or None if there's nothing to crawl.
+        '''
+        if self.frontier is not None:
+            return self.crawl_shared()
+        args, cfg = self.args, self.cfg
+        all_titles = self.all_titles
+        all_pending, all_next_pending, all_batch = self.all_pending, self.all_next_pending, self.all_batch
+        curr_level = self.curr_level
+        tot_num_titles = len(all_titles) + args['maxpages']
+
+        if curr_level > args['levels']:
+            return None
+
+        # Get list of articles to crawl
+        if args['seed']:
+            curr_titles = TitleSaver.read_title_file(cfg['seed'])
+        else:
+            curr_titles = set(all_pending)
+        self.store.discard_seen(curr_titles)
+        all_pending.replace(utils.limit_titles(all_titles, curr_titles, tot_num_titles, self.priority))
+        if len(curr_titles) == 0:
+            self.store.commit()
+            return None
+        all_batch.replace(curr_titles)
+        self.store.set_meta('batch_context', self.context)
+        self.store.commit()
+
+        # Process a batch, use links from the batch in a future batch, ...
+        # Articles are written after each batch so that a crash loses only the current batch
+        # Ctrl-C stops after the current batch
+        if self.writer is None:
+            self.writer = ArticleStreamSaver(cfg['files']['article_content_prefix'], **cfg['output'])
+        writer = self.writer
+        num_written = writer.num_written
+        all_failed = self.all_failed = set()
+        while curr_level <= args['levels'] and len(curr_titles) > 0 \
+              and writer.num_written - num_written < args['maxpages'] and not utils.stop_requested():
+            if not args['seed']: print("Level {} >>>".format(curr_level))
+            print("Processing batch of {} {} titles...".format(len(curr_titles), self.context))
+            if self.bulk:
+                # Learnt from sizes of articles in earlier calls
+                self.bproc.minibatch_size = self.api.bulk_size
+                print("Getting {} titles per API call...".format(self.bproc.minibatch_size))
+
+            # Articles are saved and their links added to the frontier as they're read,
+            # while the rest of the batch is still being fetched
+            self.num_read, self.batch_trans_titles = 0, set()
+            fetch_titles = self.triage(curr_titles) if self.triage_titles else curr_titles
+            self.bproc.batch_process(fetch_titles, self.save_articles)
+            all_failed.update(self.bproc.failed)
+            print("Read {} articles.".format(self.num_read))
+            trans_titles = self.batch_trans_titles
+
+            if not all_pending:
+                # Crawled all_pending fully: switch to all_next_pending
+                print("Switching to next level of links...")
+                if not args['seed']: curr_level = self.curr_level = self.store.level = curr_level + 1
+                curr_titles = set(all_next_pending)
+                all_next_pending.clear()
+                if args['seed'] or curr_level > args['levels']:
+                    # only one batch when seeding
+                    # newly discovered links are saved but not crawled when seeding
+                    all_pending.replace(curr_titles - all_titles)
+                    curr_titles = set()
+                else:
+                    all_pending.replace(utils.limit_titles(all_titles, curr_titles, tot_num_titles, self.priority))
+                all_next_pending -= all_pending
+            elif trans_titles:
+                # added new transcluded content
+                curr_titles = trans_titles
+                all_pending.replace(utils.limit_titles(all_titles, curr_titles, tot_num_titles, self.priority))
+                all_next_pending -= all_pending
+            else:
+                # Nothing more to crawl since reached limit in this batch
+                curr_titles = set()
+
+            # Batch is done: save its state along with titles of the next batch
+            all_batch.replace(curr_titles)
+            if not args['seed']: self.store.set_meta('curr_level', curr_level)
+            self.flush_graph()
+            self.store.commit()
+            self.save_stats()
+            if not curr_titles: break
+
+        # Failed titles are not crawled: try them again later
+        if all_failed:
+            print("Failed to get {} titles. These will be retried later.".format(len(all_failed)))
+            all_titles -= all_failed
+            if not args['seed']: all_pending |= all_failed
+
+        # Titles selected for the next batch are not crawled if stopped
+        if utils.stop_requested() and curr_titles:
+            all_titles -= curr_titles
+            if not args['seed']: all_pending |= curr_titles
+
+        all_batch.clear()
+        self.store.commit()
+        return writer.num_written - num_written
+
+    def crawl_shared(self):
+        ''' Crawl as one of many workers, up to maximum number of pages. Batches of titles are
+        leased from the shared frontier. Links found are added to it for any worker to crawl.
+        Returns number of articles saved or None if there's nothing to crawl.
+        '''
+        args, cfg, frontier = self.args, self.cfg, self.frontier
+        ccfg = cfg.get('coordination', {})
+        batch_size = ccfg.get('batch_size') or 100
+        if self.writer is None:
+            self.writer = ArticleStreamSaver(cfg['files']['article_content_prefix'], **cfg['output'])
+        writer = self.writer
+        num_written = writer.num_written
+        num_batches = 0
+        all_failed = self.all_failed = set()
+        while writer.num_written - num_written < args['maxpages'] and not utils.stop_requested():
+            num_left = args['maxpages'] - (writer.num_written - num_written)
+            level, curr_titles = frontier.claim(min(batch_size, num_left), args['levels'])
+            if not curr_titles:
+                if frontier.num_leased():
+                    # Other workers may yet find titles to crawl
+                    time.sleep(ccfg.get('poll_secs') or 5)
+                    continue
+                break
+
+            num_batches += 1
+            self.curr_level = self.store.level = level
+            print("Level {} >>>".format(level))
+            print("Processing batch of {} titles leased by worker {} of {}...".format(
+                len(curr_titles), frontier.worker, frontier.num_workers))
+            if self.bulk:
+                self.bproc.minibatch_size = self.api.bulk_size
+                print("Getting {} titles per API call...".format(self.bproc.minibatch_size))
+
+            self.num_read, self.batch_trans_titles = 0, set()
+            fetch_titles = self.triage(curr_titles) if self.triage_titles else curr_titles
+            self.bproc.batch_process(fetch_titles, self.save_articles)
+            print("Read {} articles.".format(self.num_read))
+
+            # Batch is done: other workers see it as soon as it's committed
+            # Failed titles are retried with the next level
+            failed = set(self.bproc.failed)
+            all_failed.update(failed)
+            frontier.complete(curr_titles - failed, level)
+            frontier.fail(failed, level + 1)
+            self.flush_graph()
+            self.store.commit()
+            self.save_stats()
+
+        if all_failed:
+            print("Failed to get {} titles. These will be retried later.".format(len(all_failed)))
+        self.store.commit()
+        return writer.num_written - num_written if num_batches else None
+
+    def triage(self, titles):
+        ''' Resolve titles, up to 50 per call, so that full fetches are made only for articles
+        not yet crawled. Missing pages are dropped. Redirects are replaced by their targets,
+        which are dropped if crawled or not allowed. Titles of the same page are fetched once,
+        with targets of all of them. Returns titles to fetch.
+        '''
+        print("Resolving {} titles...".format(len(titles)))
+        infos = self.iproc.batch_call_api(titles)
+        fetch_titles = set(self.iproc.failed) # fetched as they are
+        pages = {}
+        self.triaged_redirects = {}
+        num_missing, num_redirects, num_crawled = 0, 0, 0
+        for info in infos:
+            if info['missing']:
+                num_missing += 1
+                continue
+            name = info['to']
+            if info['redirect']:
+                num_redirects += 1
+                self.all_redirects.add(info['redirect']['from'])
+                if not self.afilter.is_allowed(name):
+                    self.all_discards.add(name)
+                    continue
+                self.triaged_redirects.setdefault(name, []).append(info['redirect'])
+            if str(info['pageid']) in self.all_ids:
+                num_crawled += 1
+                continue
+            targets = pages.setdefault(name, [])
+            targets.extend(t for t in self.api.split_targets(info['title']) if t not in targets)
+
+        fetch_titles.update('{}#{}'.format(name, '|'.join(targets)) if targets else name
+                            for name, targets in pages.items())
+        print("Dropped {} missing and {} crawled pages, followed {} redirects.".format(
+            num_missing, num_crawled, num_redirects))
+        stats.count('triage_missing', num_missing)
+        stats.count('triage_crawled', num_crawled)
+        stats.count('triage_redirects', num_redirects)
+        return fetch_titles
+
+    def save_articles(self, contents, next_titles, trans_titles, outlinks):
+        ''' Save articles of a chunk as soon as they're read and add their links to the frontier. '''
+        args, cfg, afilter = self.args, self.cfg, self.afilter
+        self.num_read += len(contents)
+        stats.count('articles_read', len(contents))
+
+        # Don't add duplicates: with many workers, only one of them adds a page
+        uniq_contents = []
+        inlinks = Counter()
+        level = 0 if args['seed'] else self.curr_level
+        for content, (links, transcludes) in zip(contents, outlinks):
+            currid = str(content['pageid'])
+            if self.all_ids.add(currid, content['title']):
+                uniq_contents.append(content)
+                if 'revid' in content: self.all_revids[currid] = content['revid']
+                inlinks.update(links)
+                if self.graph is not None:
+                    self.graph.add(content['title'], level, links, transcludes)
+
+        if cfg['transcludes']['add_to_curr_level']:
+            # Adding to current level is aggressive
+            # :we also won't know how long the level will run
+            # :prefer to add to next level like See also
+            trans_titles -= self.all_discards
+            trans_titles -= self.all_redirects
+            trans_titles, discarded_titles = afilter.filter_many(trans_titles)
+            self.all_discards |= discarded_titles
+            if self.frontier is not None:
+                # Workers claim titles from the shared frontier
+                self.frontier.add_current(trans_titles, self.curr_level)
+            else:
+                self.all_pending |= trans_titles
+            self.batch_trans_titles.update(trans_titles)
+        else:
+            next_titles |= trans_titles
+
+        # Titles decided in earlier batches or runs need not be filtered again
+        self.store.discard_seen(next_titles)
+        for content in uniq_contents:
+            # Redirects followed when resolving titles are kept with the article too
+            redirects = self.triaged_redirects.pop(content['title'], None)
+            if redirects:
+                content['redirects'] = (content.get('redirects') or []) + \
+                    [r for r in redirects if r not in (content.get('redirects') or [])]
+        uniq_contents, redirects_src, redirects_dst = afilter.find_redirects(uniq_contents)
+        self.all_redirects |= redirects_src # no need to crawl
+        next_titles |= redirects_dst # add for a future batch
+        start, num_bytes = time.perf_counter(), self.writer.bytes_written
+        self.writer.write(uniq_contents)
+        stats.add_time('write', time.perf_counter() - start, len(uniq_contents), self.writer.bytes_written - num_bytes)
+
+        # All seed articles must be crawled: discard none
+        next_titles, discarded_titles = afilter.filter_many(next_titles)
+        if args['seed']: discarded_titles -= self.all_pending
+        self.all_discards |= discarded_titles
+        # Titles linked from more articles are crawled first
+        self.store.add_inlinks((t, inlinks[t]) for t in next_titles if t in inlinks)
+        if self.frontier is None:
+            self.all_next_pending |= next_titles
+        else:
+            self.frontier.add(next_titles, self.store.level + 1)
+            # Others see what's been found and know this worker is alive
+            self.frontier.renew()
+            self.store.commit()
+        stats.count('articles_duplicate', len(contents) - len(uniq_contents))
+        stats.count('titles_redirected', len(redirects_src))
+        stats.count('titles_discarded', len(discarded_titles))
+        stats.count('titles_found', len(next_titles))
+
+    def flush_graph(self):
+        ''' Save links of articles read since the last flush. Done before state is committed:
+        a batch in the state is never missing from the graph.
+        '''
+        if self.graph is not None:
+            start = time.perf_counter()
+            self.graph.flush()
+            stats.add_time('graph', time.perf_counter() - start)
+
+    def save_stats(self):
+        ''' Save stats of this run so far, with sizes of sets of titles at the current level. '''
+        stats.set_frontier(self.curr_level, {status: self.store.count(status) for status in self.store.statuses})
+        if self.api.cache is not None:
+            stats.set_count('api_cache_hits', self.api.cache.hits)
+            stats.set_count('api_cache_misses', self.api.cache.misses)
+        if self.writer is not None:
+            stats.set_count('articles_written', self.writer.num_written)
+        stats.save(self.stats_file)
+
+    def close(self):
+        self.save_stats()
+        if self.frontier is not None:
+            self.frontier.release()
+        if self.api.cache is not None:
+            print("API cache: {} hits, {} misses".format(self.api.cache.hits, self.api.cache.misses))
+        self.api.close()
+        self.areader.close()
+        if self.writer is not None:
+            self.writer.close()
+        self.store.close()
@@ -1,9 +1,18 @@
 import bz2
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
 import json
 from glob import glob
+import lzma
 import os
 import os.path
 import re
+import sys
+try:
+    import zstandard
+except ImportError:
+    zstandard = None # needed only for codec zstd
 
 
 class TextSaver:
@@ -24,6 +33,139 @@ class TextSaver:
             outfile.write(text)
 
 
+class Codec:
+    ''' Compression of content files. A file is a series of compressed streams, one per
+    article: each article can be read on its own, and a whole file is read by the usual
+    tools (bzip2 -dk, gunzip, unxz, zstd -d). Codec of a file is known from its extension.
+    '''
+
+    extensions = {'bz2': 'bz2', 'gzip': 'gz', 'lzma': 'xz', 'zstd': 'zst'}
+    levels = {'bz2': 9, 'gzip': 6, 'lzma': 6, 'zstd': 3} # defaults of each library
+    ranges = {'bz2': (1, 9), 'gzip': (1, 9), 'lzma': (0, 9), 'zstd': (1, 22)}
+
+    def __init__(self, name='bz2', level=None):
+        if name not in self.extensions:
+            sys.exit("ERR: Codec '{}' is unknown. Use one of {}. Quitting...".format(
+                name, '(' + ', '.join(self.extensions) + ')'))
+        if name == 'zstd' and zstandard is None:
+            sys.exit("ERR: Codec zstd needs package zstandard: pip install zstandard. Quitting...")
+        self.name = name
+        self.level = self.levels[name] if level is None else level
+        low, high = self.ranges[name]
+        if not isinstance(self.level, int) or not low <= self.level <= high:
+            sys.exit("ERR: Level {} of codec {} is out of range {}-{}. Quitting...".format(self.level, name, low, high))
+        self.extension = self.extensions[name]
+
+    def compress(self, data):
+        if self.name == 'bz2':
+            return bz2.compress(data, self.level)
+        elif self.name == 'gzip':
+            return gzip.compress(data, self.level, mtime=0)
+        elif self.name == 'lzma':
+            return lzma.compress(data, preset=self.level)
+        else:
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    @classmethod
+    def get_extension(cls, fname):
+        return fname.rsplit('.', 1)[-1]
+
+    @classmethod
+    def decompress(cls, extension, data):
+        if extension == 'bz2':
+            return bz2.decompress(data)
+        elif extension == 'gz':
+            return gzip.decompress(data)
+        elif extension == 'xz':
+            return lzma.decompress(data)
+        else:
+            return zstandard.ZstdDecompressor().decompress(data)
+
+    @classmethod
+    def open(cls, fname):
+        ''' Open a compressed file for reading all its streams. '''
+        extension = cls.get_extension(fname)
+        if extension == 'bz2':
+            return bz2.open(fname, 'rb')
+        elif extension == 'gz':
+            return gzip.open(fname, 'rb')
+        elif extension == 'xz':
+            return lzma.open(fname, 'rb')
+        else:
+            reader = zstandard.ZstdDecompressor().stream_reader(open(fname, 'rb'), read_across_frames=True)
+            return io.BufferedReader(reader)
+
+
+_missing = object() # field an article doesn't have: None is a value like any other
+
+
+class ArticleRecord:
+    ''' Compact record of an article that's being crawled, in place of the dict from the API.
+    Common fields are slots; any other key, 'extra' included, is kept in a dict of extras.
+    Supports the dict operations used on articles: item access, 'in', get(), pop(), keys()
+    and hence dict(record). Pickled as that dict.
+    '''
+
+    fields = ('title', 'pageid', 'revid', 'displaytitle', 'text', 'html', 'redirects', 'targets', 'sections')
+    __slots__ = fields + ('_extra',)
+
+    def __init__(self, content):
+        for field in self.fields:
+            setattr(self, field, _missing)
+        self._extra = None
+        for k, v in content.items():
+            self[k] = v
+
+    def __reduce__(self):
+        return (ArticleRecord, (dict(self),))
+
+    def __getitem__(self, key):
+        value = getattr(self, key) if key in self.fields else (self._extra or {}).get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None: self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        self[key] # KeyError if missing
+        if key in self.fields:
+            setattr(self, key, _missing)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=_missing):
+        try:
+            value = self[key]
+        except KeyError:
+            if default is _missing: raise
+            return default
+        del self[key]
+        return value
+
+    def keys(self):
+        keys = [f for f in self.fields if getattr(self, f) is not _missing]
+        return keys + list(self._extra or ())
+
+
 class ArticleSaver:
     ''' Read and write content of one or more articles to disk.
     Articles are saved in JSON format.
@@ -43,20 +185,219 @@ class ArticleSaver:
         return content
 
     @classmethod
-    def write_content_file(cls, prefix, content):
+    def read_content_files(cls, prefix):
+        ''' Yield articles from all compressed content files of the given prefix, and of
+        workers of a shared crawl, if any.
+        Both JSON (one list per file) and JSON Lines (one article per line) files are read.
+        '''
+        for shard in cls.get_shards(prefix):
+            for fname in sorted(cls.get_content_files(shard), key=cls.get_file_id):
+                with Codec.open(fname) as infile:
+                    if '.jsonl.' in fname:
+                        for line in infile:
+                            yield json.loads(line.decode('utf-8'))
+                    else:
+                        yield from json.loads(infile.read().decode('utf-8'))
+
+    @classmethod
+    def get_content_files(cls, prefix):
+        return [f for f in glob(prefix + '.*.json*.*') if re.search(r'\.\d+\.jsonl?\.(bz2|gz|xz|zst)$', f)]
+
+    @classmethod
+    def get_shards(cls, prefix):
+        ''' Return the prefix and prefixes of files written by workers of a shared crawl (prefix_w{I}). '''
+        workers = set()
+        for fname in glob(prefix + '_w*.*'):
+            m = re.match(re.escape(prefix) + r'_w(\d+)\.', fname)
+            if m: workers.add(int(m.group(1)))
+        return [prefix] + ['{}_w{}'.format(prefix, w) for w in sorted(workers)]
+
+    @classmethod
+    def get_file_id(cls, fname):
+        return int(re.sub(r'.*\.(\d+)\.jsonl?\.\w+$', r'\1', os.path.basename(fname)))
+
+    @classmethod
+    def next_file_id(cls, prefix):
         # Derive the next filename suffix
-        acfiles = glob(prefix + '*.bz2')
+        acfiles = cls.get_content_files(prefix)
         if acfiles:
-            nextid = 1 + max(int(re.sub(r'.*\.(\d+)\.json\.bz2$', r'\1', os.path.basename(f))) for f in acfiles)
+            return 1 + max(cls.get_file_id(f) for f in acfiles)
         else:
-            nextid = 1 # start from 1, not 0
-        fname = "{}.{}.json.bz2".format(prefix, nextid)
+            return 1 # start from 1, not 0
+
+    @classmethod
+    def write_content_file(cls, prefix, content):
+        fname = "{}.{}.json.bz2".format(prefix, cls.next_file_id(prefix))
 
         # Unzip on Linux: bzip2 -dk *.bz2
         with bz2.open(fname, 'wb') as bzfile:
             bzfile.write(json.dumps(content, indent=2).encode('utf-8'))
 
 
+class ArticleStreamSaver:
+    ''' Write articles to disk as they're crawled rather than all at the end.
+    Articles are saved in JSON Lines format, one compact JSON record per line.
+    Each article is a separate compressed stream, so that it can be read on its own. Its location
+    is appended to a sidecar index file, read by ArticleStore. Whatever's written by write()
+    survives a crash. Files are rotated when they reach max_records articles or max_mb size,
+    between articles: a file goes past max_mb by less than one article.
+    Articles are compressed with codec bz2 (default), gzip, lzma or zstd at the given level,
+    by up to 'threads' threads at a time: compression doesn't hold the GIL.
+    '''
+
+    def __init__(self, prefix, max_records=1000, max_mb=64, codec='bz2', level=None, threads=4):
+        self.prefix = prefix
+        self.max_records = max_records
+        self.max_size = max_mb * 1024 * 1024
+        self.codec = Codec(codec, level)
+        self.executor = ThreadPoolExecutor(threads) if threads and threads > 1 else None
+        self.index_fname = ArticleStore.get_index_file(prefix)
+        # A crash may have left a file with articles that weren't indexed: never append to it
+        last = ArticleStore.last_file_id(self.index_fname)
+        self.fileid = max(ArticleSaver.next_file_id(prefix), 1 if last is None else last + 1)
+        self.fname = None
+        self.num_records = 0
+        self.num_written = 0
+        self.bytes_written = 0
+
+    def write(self, articles):
+        ''' Write articles, rotating files as needed. '''
+        for start in range(0, len(articles), self.max_records):
+            # Articles are compressed at the same time, but written in order
+            chunk = articles[start:start+self.max_records]
+            lines = [(json.dumps(dict(article), separators=(',', ':')) + '\n').encode('utf-8') for article in chunk]
+            if self.executor is not None and len(lines) > 1:
+                blocks = list(self.executor.map(self.codec.compress, lines))
+            else:
+                blocks = [self.codec.compress(line) for line in lines]
+
+            while blocks:
+                if self.fname is None or self.num_records >= self.max_records or self.offset >= self.max_size:
+                    self.rotate()
+                # As many articles as fit in the current file
+                num, size = 0, self.offset
+                while num < len(blocks) and self.num_records + num < self.max_records and size < self.max_size:
+                    size += len(blocks[num])
+                    num += 1
+                self.append(chunk[:num], blocks[:num])
+                chunk, blocks = chunk[num:], blocks[num:]
+
+    def append(self, articles, blocks):
+        entries = []
+        for article, block in zip(articles, blocks):
+            entries.append(ArticleStore.make_entry(article, self.fileid, self.offset, len(block)))
+            self.offset += len(block)
+
+        # Index only what's already on disk
+        with open(self.fname, 'ab') as outfile:
+            outfile.write(b''.join(blocks))
+        with open(self.index_fname, 'a', encoding='utf-8') as outfile:
+            outfile.write(''.join(entries))
+        self.num_records += len(blocks)
+        self.num_written += len(blocks)
+        self.bytes_written += sum(len(block) for block in blocks)
+
+    def rotate(self):
+        if self.fname is not None:
+            self.fileid += 1
+        self.fname = "{}.{}.jsonl.{}".format(self.prefix, self.fileid, self.codec.extension)
+        self.num_records = 0
+        self.offset = 0
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class ArticleStore:
+    ''' Read single articles saved by ArticleStreamSaver without reading whole files.
+    The sidecar index maps title, page ID and revision ID of each article to its location
+    (file, offset, length). Titles of redirects to the article are also indexed.
+    Index is loaded once, so each lookup reads and decompresses only the one article.
+    If an article was saved more than once (eg. when refreshed), the latest is returned.
+    Files written by workers of a shared crawl (prefix_w{I}) are read along with the prefix's own.
+    '''
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.by_title = {}
+        self.by_pageid = {}
+        # Files of a crawl may have been written with different codecs
+        self.files = {}
+        for shard in ArticleSaver.get_shards(prefix):
+            self.files.update(((shard, ArticleSaver.get_file_id(f)), f) for f in ArticleSaver.get_content_files(shard))
+            try:
+                with open(self.get_index_file(shard), 'r', encoding='utf-8') as infile:
+                    for line in infile:
+                        fields = line.rstrip('\n').split('\t')
+                        pageid, revid, fileid, offset, length = (int(f) if f else None for f in fields[:5])
+                        loc = (pageid, revid, (shard, fileid), offset, length)
+                        self.by_pageid[pageid] = loc
+                        for title in fields[5:]:
+                            self.by_title[title] = loc
+            except FileNotFoundError:
+                pass
+
+    def __len__(self):
+        return len(self.by_pageid)
+
+    def __contains__(self, title):
+        return title in self.by_title
+
+    def titles(self):
+        return self.by_title.keys()
+
+    def get(self, title):
+        ''' Return the article of this title or None if there's no such article. '''
+        return self.read(self.by_title.get(title))
+
+    def get_by_pageid(self, pageid):
+        return self.read(self.by_pageid.get(int(pageid)))
+
+    def get_revid(self, title):
+        loc = self.by_title.get(title)
+        return loc[1] if loc else None
+
+    def read(self, loc):
+        if loc is None:
+            return None
+        pageid, revid, fileid, offset, length = loc
+        fname = self.files.get(fileid) or "{}.{}.jsonl.bz2".format(*fileid)
+        with open(fname, 'rb') as infile:
+            infile.seek(offset)
+            return json.loads(Codec.decompress(Codec.get_extension(fname), infile.read(length)).decode('utf-8'))
+
+    @classmethod
+    def get_index_file(cls, prefix):
+        return prefix + '.index.tsv'
+
+    @classmethod
+    def make_entry(cls, article, fileid, offset, length):
+        # Titles can't contain tabs or newlines
+        titles = [article['title']]
+        if 'redirects' in article:
+            titles.extend(rdt['from'] for rdt in article['redirects'] if 'from' in rdt)
+        fields = [article.get('pageid', ''), article.get('revid', ''), fileid, offset, length] + titles
+        return '\t'.join(str(f) for f in fields) + '\n'
+
+    @classmethod
+    def last_file_id(cls, fname):
+        ''' Return file ID of the last indexed article, reading only the end of the index. '''
+        try:
+            with open(fname, 'rb') as infile:
+                # An entry with many redirects can be longer than a block: read back to its start
+                data, pos = b'', infile.seek(0, os.SEEK_END)
+                while pos > 0 and b'\n' not in data.rstrip(b'\n'):
+                    size = min(4096, pos)
+                    pos -= size
+                    infile.seek(pos)
+                    data = infile.read(size) + data
+        except FileNotFoundError:
+            return None
+        lines = data.splitlines()
+        return int(lines[-1].split(b'\t')[2]) if lines else None
+
+
 class TitleSaver:
     ''' Read and write article titles to disk in text format.
     Each line has one title.
@@ -80,3 +421,24 @@ class TitleSaver:
             for t in titles:
                 outfile.write(t + "\n")
 
+
+class RevisionSaver:
+    ''' Read the revision of each crawled article from disk in text format, as saved
+    before the state moved to crawl_state.db. Each line has a page ID and a revision ID
+    separated by a tab.
+    '''
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def read_revision_file(cls, fname):
+        revids = {}
+        try:
+            with open(fname, 'r', encoding='utf-8') as infile:
+                for line in infile:
+                    pageid, revid = line.split()
+                    revids[pageid] = int(revid)
+        except FileNotFoundError:
+            pass
+        return revids
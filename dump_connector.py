@@ -0,0 +1,218 @@
+import bz2
+from collections import OrderedDict
+import os
+import sqlite3
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+import mwclient
+from api_connector import ApiConnector
+from crawl_stats import stats
+
+
+class DumpConnector(ApiConnector):
+    ''' Read articles from a local XML dump of Wikipedia rather than calling the API.
+    A multistream dump (pages-articles-multistream.xml.bz2) is a series of bz2 streams
+    of 100 pages each. Its index file has a line 'offset:pageid:title' for every page.
+    Only the stream holding a requested title is decompressed. Recently used streams
+    are kept in memory, up to configuration 'cache_blocks' of them.
+    Wikitext is available but not HTML: articles are as in bulk mode.
+    Methods have the same names as in ApiConnector and return the same content.
+    '''
+
+    is_local = True
+
+    def __init__(self, **kwargs):
+        dump = kwargs.get('dump') or {}
+        if not dump.get('file') or not os.path.exists(dump['file']):
+            sys.exit("ERR: Dump file '{}' is missing. Set api.dump.file in configuration. Quitting...".format(
+                dump.get('file')))
+        if not dump.get('index') or not os.path.exists(dump['index']):
+            sys.exit("ERR: Dump index '{}' is missing. Set api.dump.index in configuration. Quitting...".format(
+                dump.get('index')))
+        # Nothing is requested: there's nothing to cache
+        super().__init__(**dict(kwargs, endpoint=kwargs.get('endpoint') or 'dump', cache={}))
+
+    def connect(self):
+        self.site = None # never used
+        self.dump = self.config['dump']
+        if 'cache_blocks' not in self.dump or not self.dump['cache_blocks']:
+            self.dump['cache_blocks'] = 32
+        if 'index_db' not in self.dump or not self.dump['index_db']:
+            self.dump['index_db'] = self.dump['index'] + '.db'
+        self.load_index()
+        self.blocks = OrderedDict()
+        self.loading = {} # offset: event set when the stream is loaded
+        self.lock = threading.Lock()
+        self.files = threading.local() # file of each thread: no seek() by others in between
+
+    def load_index(self):
+        ''' Index is copied into SQLite once: titles are looked up without loading all of them.
+        It's built into a temporary file that's renamed when complete: an interrupted build
+        is started again rather than used.
+        '''
+        self.index_lock = threading.Lock()
+        if not os.path.exists(self.dump['index_db']):
+            self.build_index()
+        self.index = sqlite3.connect(self.dump['index_db'], check_same_thread=False)
+
+    def build_index(self):
+        print("Loading dump index {} into {}...".format(self.dump['index'], self.dump['index_db']))
+        tmp_db = self.dump['index_db'] + '.tmp'
+        if os.path.exists(tmp_db):
+            os.remove(tmp_db)
+        index = sqlite3.connect(tmp_db)
+        index.execute('CREATE TABLE pages (title TEXT PRIMARY KEY, pageid INTEGER, offset INTEGER) WITHOUT ROWID')
+        rows = []
+        with bz2.open(self.dump['index'], 'rt', encoding='utf-8') as infile:
+            for line in infile:
+                offset, pageid, title = line.rstrip('\n').split(':', 2)
+                rows.append((title, int(pageid), int(offset)))
+                if len(rows) >= 100000:
+                    index.executemany('INSERT OR REPLACE INTO pages VALUES (?,?,?)', rows)
+                    rows = []
+        index.executemany('INSERT OR REPLACE INTO pages VALUES (?,?,?)', rows)
+        index.commit()
+        index.close()
+        os.replace(tmp_db, self.dump['index_db'])
+
+    def close(self):
+        with self.index_lock:
+            self.index.close()
+
+    def call(self, action, **params):
+        raise mwclient.errors.APIError('notindump', "Action '{}' is not served from a dump".format(action), params)
+
+    def normalize(self, title):
+        # As the API does for titles of links: first letter of the title is capitalized
+        title = title.replace('_', ' ').strip()
+        return title[:1].upper() + title[1:]
+
+    def read_block(self, offset):
+        ''' Return pages of the stream at offset, keyed by title.
+        A stream is decompressed by one thread while others that need it wait.
+        '''
+        while True:
+            with self.lock:
+                if offset in self.blocks:
+                    self.blocks.move_to_end(offset)
+                    return self.blocks[offset]
+                loaded = self.loading.get(offset)
+                if loaded is None:
+                    loaded = self.loading[offset] = threading.Event()
+                    break
+            loaded.wait()
+
+        try:
+            pages = self.load_block(offset)
+            with self.lock:
+                self.blocks[offset] = pages
+                while len(self.blocks) > self.dump['cache_blocks']:
+                    self.blocks.popitem(last=False)
+        finally:
+            with self.lock:
+                del self.loading[offset]
+            loaded.set()
+        return pages
+
+    def load_block(self, offset):
+        start = time.perf_counter()
+        infile = getattr(self.files, 'dump', None)
+        if infile is None:
+            infile = self.files.dump = open(self.dump['file'], 'rb')
+        infile.seek(offset)
+        decompressor = bz2.BZ2Decompressor()
+        chunks, nbytes = [], 0
+        while not decompressor.eof:
+            data = infile.read(256 * 1024)
+            if not data: break
+            nbytes += len(data)
+            chunks.append(decompressor.decompress(data))
+        nbytes -= len(decompressor.unused_data)
+
+        # Last stream also closes the document
+        xml = b''.join(chunks).replace(b'</mediawiki>', b'')
+        pages = {}
+        for page in ET.fromstring(b'<pages>' + xml + b'</pages>').iter('page'):
+            redirect = page.find('redirect')
+            revision = page.find('revision')
+            pages[page.findtext('title')] = {
+                'title': page.findtext('title'),
+                'ns': int(page.findtext('ns', '0')),
+                'pageid': int(page.findtext('id')),
+                'revid': int(revision.findtext('id')) if revision is not None else None,
+                'redirect': redirect.get('title') if redirect is not None else None,
+                'text': revision.findtext('text', '') if revision is not None else ''
+            }
+        stats.observe_call('dump', time.perf_counter() - start, nbytes)
+        return pages
+
+    def find_page(self, title):
+        with self.index_lock:
+            row = self.index.execute('SELECT offset FROM pages WHERE title=?', (title,)).fetchone()
+        return None if row is None else self.read_block(row[0]).get(title)
+
+    def follow(self, title):
+        ''' Return the page of a title, following redirects, and the redirects followed. '''
+        name = self.normalize(title.split('#')[0])
+        page, redirects = self.find_page(name), []
+        while page is not None and page['redirect'] and len(redirects) < 2: # API follows no more
+            dst = self.normalize(page['redirect'].split('#')[0])
+            redirects.append({'from': page['title'], 'to': dst})
+            page = self.find_page(dst)
+        return page, redirects
+
+    def get_text(self, title):
+        ''' Given an article title, return the full text in Wikitext format.
+        Redirects are not followed.
+        '''
+        page = self.find_page(self.normalize(title.split('#')[0]))
+        if page is None:
+            return {'title': title, 'text': ''}
+        return {'title': title, 'pageid': page['pageid'], 'revid': page['revid'], 'text': page['text']}
+
+    def get_parsed_text(self, title):
+        ''' Given an article title, return its page as parsing would, but with only wikitext.
+        Redirects are followed.
+        '''
+        targets = self.split_targets(title)
+        page, redirects = self.follow(title)
+        if page is None or page['redirect']:
+            return {'title': title, 'text': ''}
+
+        article = {'title': page['title'], 'pageid': page['pageid'], 'revid': page['revid'], 'text': page['text']}
+        if redirects:
+            article['redirects'] = redirects
+        if targets:
+            article['targets'] = targets
+        return article
+
+    def get_texts(self, titles):
+        ''' Given many article titles, return full text of each in Wikitext format.
+        Titles that redirect to the same page give one article, as with the API.
+        '''
+        if not isinstance(titles, (list, tuple)):
+            titles = [titles]
+        pages = {}
+        for title in titles:
+            article = self.get_parsed_text(title)
+            if not article['text']: continue
+            merged = pages.setdefault(article['title'], article)
+            if merged is not article:
+                for key in ('redirects', 'targets'):
+                    merged.setdefault(key, []).extend(v for v in article.get(key, []) if v not in merged[key])
+        return list(pages.values())
+
+    def get_lastrevids(self, titles):
+        ''' Given many article titles, return page ID and ID of latest revision in the dump. '''
+        if not isinstance(titles, (list, tuple)):
+            titles = [titles]
+        infos = []
+        for title in titles:
+            page, _ = self.follow(title)
+            if page is None:
+                infos.append({'title': title, 'missing': ''})
+            else:
+                infos.append({'title': page['title'], 'pageid': page['pageid'], 'lastrevid': page['revid']})
+        return infos
@@ -0,0 +1,247 @@
+import os
+import sqlite3
+import numpy as np
+
+
+class LinkGraph:
+    ''' Links and transcludes of every crawled article, kept compactly on disk.
+    Titles are interned to integer IDs, in order of first use, in a SQLite table (titles.db):
+    they're looked up when needed rather than held in memory. Edges are in CSR form: for the
+    articles of a segment, sorted by ID, edges of the i-th article are edges[ptr[i]:ptr[i+1]].
+    Each batch is appended as a new segment of .npy files that are memory-mapped when read.
+    Segments are merged in tiers, newest record of an article first: a refreshed article
+    replaces its older links. Like carries of a binary counter, the newest segments are merged
+    into one while the segment before them is no bigger than they are: there are about
+    log2(batches) segments and each record is rewritten about as many times. There are never
+    more than max_segments of them. Only flush() merges segments: queries merge them in memory,
+    so the graph can be read while a crawl is adding to it.
+    '''
+
+    kinds = ('links', 'transcludes')
+    arrays = ('links_ptr', 'links', 'transcludes_ptr', 'transcludes')
+    chunk = 500 # titles per query, below SQLite's limit on parameters
+
+    def __init__(self, path, max_segments=16):
+        self.path = path
+        self.max_segments = max_segments or 16
+        os.makedirs(path, exist_ok=True)
+        self.titles_db = os.path.join(path, 'titles.db')
+        is_new = not os.path.exists(self.titles_db)
+        self.db = sqlite3.connect(self.titles_db, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS titles (id INTEGER PRIMARY KEY, title TEXT NOT NULL UNIQUE)')
+        if is_new:
+            self.migrate()
+        self.pending = [] # (title, level, links, transcludes) not yet in a segment
+        self.segments = self.load_segments()
+        self.degrees = {}
+
+    def migrate(self):
+        ''' Load IDs of titles saved one per line in titles.txt by earlier versions.
+        The text file is left as it is.
+        '''
+        fname = os.path.join(self.path, 'titles.txt')
+        if os.path.exists(fname):
+            with open(fname, encoding='utf-8') as infile:
+                self.db.executemany('INSERT INTO titles VALUES (?,?)',
+                                    ((i, line.rstrip('\n')) for i, line in enumerate(infile)))
+            self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COALESCE(MAX(id) + 1, 0) FROM titles').fetchone()[0]
+
+    def __contains__(self, title):
+        return title in self.get_ids([title])
+
+    def get_ids(self, titles, add=False):
+        ''' Return a dict of IDs of the titles. With add, titles without an ID are given one.
+        IDs given are saved with the next commit.
+        '''
+        titles = list(dict.fromkeys(titles))
+        ids = {}
+        for i in range(0, len(titles), self.chunk):
+            chunk = titles[i:i+self.chunk]
+            ids.update(self.db.execute('SELECT title, id FROM titles WHERE title IN ({})'.format(
+                ','.join('?' * len(chunk))), chunk))
+        if add:
+            new = [t for t in titles if t not in ids]
+            start = len(self)
+            ids.update((t, start + i) for i, t in enumerate(new))
+            self.db.executemany('INSERT INTO titles VALUES (?,?)', ((ids[t], t) for t in new))
+        return ids
+
+    def get_titles(self, ids):
+        ''' Return a list of titles of the IDs, in the same order. '''
+        ids = [int(i) for i in ids]
+        titles = {}
+        for i in range(0, len(ids), self.chunk):
+            chunk = ids[i:i+self.chunk]
+            titles.update(self.db.execute('SELECT id, title FROM titles WHERE id IN ({})'.format(
+                ','.join('?' * len(chunk))), chunk))
+        return [titles[i] for i in ids]
+
+    def add(self, title, level, links, transcludes):
+        ''' Record an article crawled at a level. Saved with the next flush(). '''
+        self.pending.append((title, level, list(links), list(transcludes)))
+
+    def flush(self):
+        ''' Save articles added since the last flush as a new segment. '''
+        if not self.pending:
+            return
+        # Titles first: a segment never refers to IDs that aren't saved
+        ids = self.get_ids((t for r in self.pending for t in [r[0]] + r[2] + r[3]), add=True)
+        self.db.commit()
+
+        # Later record of an article in the same segment wins
+        records = {}
+        for title, level, links, transcludes in self.pending:
+            records[ids[title]] = (ids[title], level, sorted(ids[t] for t in links), sorted(ids[t] for t in transcludes))
+        records = [records[i] for i in sorted(records)]
+        segment = {'nodes': np.array([(r[0], r[1]) for r in records], dtype=np.int32).reshape(-1, 2)}
+        for k, kind in enumerate(self.kinds):
+            lengths = [len(r[2+k]) for r in records]
+            segment[kind + '_ptr'] = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+            segment[kind] = np.fromiter((i for r in records for i in r[2+k]), dtype=np.int32)
+        self.pending = []
+        self.save_segment(segment)
+        self.compact(self.num_to_merge())
+
+    def segment_numbers(self):
+        # Nodes file is written last: a segment without it is incomplete
+        return sorted(int(fname.split('.')[0]) for fname in os.listdir(self.path) if fname.endswith('.nodes.npy'))
+
+    def segment_file(self, num, name):
+        return os.path.join(self.path, '{:06d}.{}.npy'.format(num, name))
+
+    def load_segments(self):
+        # Segments listed may be removed by a crawl merging them: list them again
+        while True:
+            try:
+                return [self.load_segment(n) for n in self.segment_numbers()]
+            except FileNotFoundError:
+                pass
+
+    def load_segment(self, num):
+        segment = {'num': num}
+        for name in ('nodes',) + self.arrays:
+            segment[name] = np.load(self.segment_file(num, name), mmap_mode='r')
+        return segment
+
+    def save_segment(self, segment, num=None):
+        if num is None:
+            num = self.segments[-1]['num'] + 1 if self.segments else 0
+        # Each file is renamed when complete: readers never load part of one
+        for name in self.arrays + ('nodes',):
+            fname = self.segment_file(num, name)
+            with open(fname + '.tmp', 'wb') as outfile:
+                np.save(outfile, segment[name])
+            os.replace(fname + '.tmp', fname)
+        self.segments.append(self.load_segment(num))
+        self.degrees = {}
+
+    @classmethod
+    def size(cls, segment):
+        return len(segment['nodes']) + sum(len(segment[kind]) for kind in cls.kinds)
+
+    def num_to_merge(self):
+        ''' Return the number of newest segments to merge into one after a flush. '''
+        sizes = [self.size(s) for s in self.segments]
+        num, total = 1, sum(sizes[-1:])
+        while num < len(sizes) and (sizes[-num-1] <= total or len(sizes) - num >= self.max_segments):
+            total += sizes[-num-1]
+            num += 1
+        return num
+
+    def compact(self, num=None):
+        ''' Merge the newest num segments into one, all of them by default. '''
+        num = len(self.segments) if num is None else num
+        if num <= 1:
+            return
+        olds = self.segments[-num:]
+        merged = self.merge(olds)
+        # New segment is complete before old ones are removed. It's numbered after them:
+        # a reader that lists both finds the same newest records.
+        self.segments = self.segments[:-num]
+        self.save_segment(merged, olds[-1]['num'] + 1)
+        for s in olds:
+            for name in ('nodes',) + self.arrays:
+                os.remove(self.segment_file(s['num'], name))
+
+    @classmethod
+    def merge(cls, segments, kinds=None):
+        ''' Return arrays of the segments merged in memory, the newest record of each article. '''
+        newest = segments[::-1]
+        # Unique keeps the first of repeated IDs, from the newest segment, sorted by ID
+        nodes = np.concatenate([s['nodes'] for s in newest])
+        _, rows = np.unique(nodes[:, 0], return_index=True)
+        merged = {'nodes': nodes[rows]}
+        for kind in kinds or cls.kinds:
+            starts, ends, offset = [], [], 0
+            for s in newest:
+                ptr = np.asarray(s[kind + '_ptr'])
+                starts.append(ptr[:-1] + offset)
+                ends.append(ptr[1:] + offset)
+                offset += ptr[-1]
+            edges = np.concatenate([s[kind] for s in newest])
+            merged[kind + '_ptr'], merged[kind] = gather(np.concatenate(starts)[rows], np.concatenate(ends)[rows], edges)
+        return merged
+
+    def find(self, title):
+        ''' Return segment and row of the latest record of a crawled article, if any. '''
+        i = self.get_ids([title]).get(title)
+        if i is None:
+            return None, None
+        for segment in reversed(self.segments):
+            ids = segment['nodes'][:, 0]
+            row = np.searchsorted(ids, i)
+            if row < len(ids) and ids[row] == i:
+                return segment, row
+        return None, None
+
+    def out_neighbours(self, title, kind='links'):
+        ''' Return titles that a crawled article links to or transcludes. '''
+        segment, row = self.find(title)
+        if segment is None:
+            return []
+        ptr = segment[kind + '_ptr']
+        return self.get_titles(segment[kind][ptr[row]:ptr[row+1]])
+
+    def level(self, title):
+        ''' Return level at which an article was crawled, if it was. '''
+        segment, row = self.find(title)
+        return None if segment is None else int(segment['nodes'][row, 1])
+
+    def in_degrees(self, kind='links'):
+        ''' Return an array of the number of crawled articles linking to each title, indexed by ID. '''
+        if kind not in self.degrees:
+            degrees = np.zeros(len(self), dtype=np.int64)
+            if self.segments:
+                # Only the latest record of an article counts: merged, else refreshed articles count twice
+                counts = np.bincount(self.merge(self.segments, [kind])[kind])
+                degrees[:len(counts)] += counts
+            self.degrees[kind] = degrees
+        return self.degrees[kind]
+
+    def in_degree(self, title, kind='links'):
+        i = self.get_ids([title]).get(title)
+        return 0 if i is None else int(self.in_degrees(kind)[i])
+
+    def subgraph(self, level, kind='links'):
+        ''' Return arrays of source and destination IDs of edges between articles crawled at a level. '''
+        if not self.segments:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        merged = self.merge(self.segments, [kind])
+        nodes, ptr = merged['nodes'], merged[kind + '_ptr']
+        levels = np.full(len(self), -1, dtype=np.int32)
+        levels[nodes[:, 0]] = nodes[:, 1]
+        src = np.repeat(nodes[:, 0], np.diff(ptr))
+        dst = merged[kind]
+        mask = (levels[src] == level) & (levels[dst] == level)
+        return src[mask], dst[mask]
+
+
+def gather(starts, ends, edges):
+    ''' Return CSR pointers and edges of the slices edges[starts[i]:ends[i]]. '''
+    lengths = ends - starts
+    ptr = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    index = np.repeat(starts - ptr[:-1], lengths) + np.arange(ptr[-1])
+    return ptr, edges[index].astype(np.int32)
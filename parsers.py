@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
+from html.parser import HTMLParser
 import re
 import sys
-from bs4 import BeautifulSoup
 
 
 class Parser(ABC):
@@ -29,6 +29,10 @@ class Parser(ABC):
 
         return clnk
 
+    # Compiled once: filter_links is called for every link of every article
+    external_link = re.compile(r'^\s*(https?:)?//', flags=re.I)
+    edit_link = re.compile(r'^\s*/w/.*action=edit', flags=re.I)
+
     def filter_links(self, links):
         flinks = []
         for link in links:
@@ -36,18 +40,86 @@ class Parser(ABC):
             if not link: continue
             
             # ignore external links
-            if re.search(r'^\s*(https?:)?//', link, flags=re.I):
+            if '//' in link and self.external_link.search(link):
                 continue
 
             # ignore edit links
             # eg. /w/index.php?title=Electric Imp&action=edit&redlink=1
-            if re.search(r'^\s*/w/.*action=edit', link, flags=re.I):
+            if '/w/' in link and self.edit_link.search(link):
                 continue
 
             flinks.append(link)
         return flinks
 
 
+class SectionIndex:
+    ''' Sections of wikitext as a tree, found with one scan for headings.
+    Each section is a dict of its heading 'title', 'level' (2 for == A ==), 'start' of its
+    heading line, 'body' after the heading line and 'end': start of the next heading of the
+    same or a higher level, else end of text. A section thus includes its subsections.
+    Sections are in order of the text, each followed by its subsections. Offsets are of
+    characters in the text, for slicing it: text before the first heading is the lead.
+    '''
+
+    # Level is set by the shorter run of = : == A === is a level 2 heading 'A ='
+    heading = re.compile(r'\n(=+)[ \t]*([^\n]*?)[ \t]*(=+)[ \t]*(?=\n|$)')
+
+    def __init__(self, text=None, sections=None):
+        self.sections = self.parse(text) if sections is None else sections
+
+    @classmethod
+    def parse(cls, text):
+        # Text starting with a heading has no newline before it
+        shift = 1 if text.startswith('=') else 0
+        sections, open_sections = [], []
+        for m in cls.heading.finditer('\n' + text if shift else text):
+            left, title, right = m.groups()
+            level = min(len(left), len(right))
+            title = ('=' * (len(left) - level) + title + '=' * (len(right) - level)).strip()
+            if not title: continue
+            start = m.start() + 1 - shift
+            while open_sections and open_sections[-1]['level'] >= level:
+                open_sections.pop()['end'] = start
+            section = {'title': title, 'level': level, 'start': start, 'body': m.end() - shift, 'end': len(text)}
+            sections.append(section)
+            open_sections.append(section)
+        return sections
+
+    def find(self, title=None, level=None):
+        ''' Return sections of a level whose titles fully match a compiled pattern. '''
+        return [s for s in self.sections if (level is None or s['level'] == level) and
+                (title is None or title.fullmatch(s['title']))]
+
+    def spans(self, sections):
+        ''' Return (start, end) of bodies of sections, excluding those within others. '''
+        spans = []
+        for s in sections:
+            if spans and s['start'] < spans[-1][1]: continue
+            spans.append((s['body'], s['end']))
+        return spans
+
+
+class WikitextScanner:
+    ''' Find links, hatnotes and article transclusions in wikitext.
+    Patterns are compiled once. Each kind is found by its own findall, which in CPython is
+    faster than visiting openers ([[, {{) of all kinds in a single Python-level pass:
+    a regex with more than one opener loses the fast search for a literal prefix.
+    '''
+
+    link = re.compile(r'\[\[([^#|\]]+)[#\|]?.*?\]\]')
+    hatnote = re.compile(r'\{\{\s*(?:Main|See\s+also)\s*\|?(.*?)\}\}', flags=re.I|re.S)
+    transclude = re.compile(r'\{\{:([^|#}]+).*?\}\}', flags=re.S)
+
+    def scan(self, text, links=True, hatnotes=True, transcludes=False):
+        ''' Return lists of link targets, hatnote contents and transcluded article titles,
+        for kinds that are wanted.
+        '''
+        found_links = self.link.findall(text) if links else []
+        found_hatnotes = self.hatnote.findall(text) if hatnotes else []
+        found_transcludes = self.transclude.findall(text) if transcludes else []
+        return found_links, found_hatnotes, found_transcludes
+
+
 class WikitextParser(Parser):
     ''' Parser for Wikitext format.
     Wikitext syntax is documented at https://en.wikipedia.org/wiki/Help:Cheatsheet
@@ -58,15 +130,24 @@ class WikitextParser(Parser):
 
         # Links are within [[]], remove targets
         self.linkpatt = r'\[\[([^#|\]]+)[#\|]?.*?\]\]'
-
-    def add_links(self, dst, text, patt=None, flags=0):
-        if patt is None: patt = self.linkpatt
-        links = re.findall(patt, text, flags=flags)
-        links = [self.clean_link(link) for link in links]
-        dst.extend(links)
-
-    def get_seed_links(self, text, targets):
-        targets = '|'.join(targets) if targets else '.*?'
+        self.scanner = WikitextScanner()
+        self.list_item = re.compile(r'^\s*(?:\*+|\|)\s*{}'.format(self.linkpatt), flags=re.I|re.M)
+        self.index_heading = re.compile(r'[A-Z]')
+        self.see_also_heading = re.compile(r'See\s+also', flags=re.I)
+
+    def add_links(self, dst, text, patt=None, flags=0, spans=None):
+        ''' Add links found in text, or only within (start, end) spans of it. '''
+        if patt is None:
+            patt = self.scanner.link
+        elif not hasattr(patt, 'findall'):
+            patt = re.compile(patt, flags=flags)
+        for start, end in spans if spans is not None else [(0, len(text))]:
+            dst.extend(self.clean_link(link) for link in patt.findall(text, start, end))
+
+    def get_seed_links(self, text, targets, sections=None):
+        if sections is None:
+            sections = SectionIndex(text)
+        patt_targets = '|'.join(targets) if targets else '.*?'
 
         all_links = []
 
@@ -78,26 +159,21 @@ class WikitextParser(Parser):
         # sections marked by header: eg. : '''''[[Computing]]''''', :: '''''[[Computing]]'''''
         # TODO Without extra sections after last section, end links will also be retrieved
         sectexts = re.findall(
-            r"\n(?P<start>:+)\s*'''''\s*\[\[(?:{})\]\]'''''(.*?)(?=\n(?P=start)[^:])".format(targets),
+            r"\n(?P<start>:+)\s*'''''\s*\[\[(?:{})\]\]'''''(.*?)(?=\n(?P=start)[^:])".format(patt_targets),
             text + "\n:::::::", flags=re.S)
         ftext = ' '.join(stext[1] for stext in sectexts)
         self.add_links(all_links, ftext)
 
         # ---- outlines ----
         # ---- lists ----
-        # optional: targets (separated by |) are used to specify sections to consider
+        # optional: targets are used to specify sections to consider, with their subsections
+        spans = None
         if targets:
-            sectexts = re.findall(
-                r"\n(?P<start>=+)\s*(?:{})\s*(?P=start)\s*\n(.*?)(?=\n(?P=start)[^=])".format(targets),
-                text+"\n========", flags=re.S)
-            ftext = ' '.join(stext[1] for stext in sectexts)
-        else:
-            ftext = text
+            spans = sections.spans(sections.find(re.compile('(?:{})'.format(patt_targets))))
         # list items: lines that start with: * [[...]], ** [[...]]
         # list items in table: lines that start with: | [[...]]
         # Side-effect: captures See also list items
-        patt = r'^\s*(?:\*+|\|)\s*{}'.format(self.linkpatt)
-        self.add_links(all_links, ftext, patt, re.I|re.M)
+        self.add_links(all_links, text, self.list_item, spans=spans)
 
         # ---- portals ----
         # Ignored because it's not useful
@@ -110,33 +186,31 @@ class WikitextParser(Parser):
         # ---- indices ----
         # sections marked by header: eg. == A ==, == Z ==
         # may include links to categories: eg. :Category:Biotechnology, Category:Biotechnology
-        # TODO Without extra sections after last alphabet index section, end links will also be retrieved
-        sectexts = re.findall(r'\n==\s*[A-Z]\s*==\s*\n(.*?)(?=\n==)', text + "\n==", flags=re.S)
-        for stext in sectexts:
-            self.add_links(all_links, stext)
+        self.add_links(all_links, text, spans=sections.spans(sections.find(self.index_heading, level=2)))
 
         return set(self.filter_links(all_links))
 
     def get_links(self, title, text):
-        all_links = []
-
-        if 'Template:' in title:
-            self.add_links(all_links, text)
+        links, transcludes = self.get_links_and_transcludes(title, text, transcludes=False)
+        return links
 
-        #elif 'Category:' in title: TODO
-        #    self.add_links(all_links, text)
-
-        elif self.config['restricted']:
-            # ---- See also ----
-            # TODO Ignores See also if it's the last section (rare case?)
-            # Multiple See also sections possible (but unlikely?) if another article 
-            # is substituted within this one
-            satexts = re.findall(r'\n==\s*See\s+also\s*==(.*?)(?=\n==)', text, flags=re.I|re.S)
-            for satext in satexts:
-                self.add_links(all_links, satext)
-
-        else:
-            self.add_links(all_links, text)
+    def get_transcludes(self, text):
+        found = self.scanner.scan(text, links=False, hatnotes=False, transcludes=True)
+        return self.read_transcludes(found[2])
+
+    def get_links_and_transcludes(self, title, text, transcludes=True, sections=None):
+        ''' Get links and, optionally, transcluded articles from one call to the scanner. '''
+        # ---- See also ----
+        # Multiple See also sections possible (but unlikely?) if another article 
+        # is substituted within this one
+        see_also = 'Template:' not in title and self.config['restricted']
+
+        found_links, hats, found_transcludes = self.scanner.scan(text, links=not see_also, transcludes=transcludes)
+        if see_also:
+            if sections is None:
+                sections = SectionIndex(text)
+            for start, end in sections.spans(sections.find(self.see_also_heading, level=2)):
+                found_links.extend(self.scanner.link.findall(text, start, end))
 
         # ---- Hatnote templates ----
         # https://en.wikipedia.org/wiki/Wikipedia:Hatnote#Hatnote_templates
@@ -144,31 +218,60 @@ class WikitextParser(Parser):
         # https://tools.wmflabs.org/templatecount/index.php
         # {{Main|p1|p2|l1=label1|l2=label2|...|selfref=yes}}
         # {{See also|p1|p2|l1=label1|l2=label2|...|selfref=yes|category=no}}
-        hats = re.findall(r'\{\{\s*(?:Main|See\s+also)\s*\|?(.*?)\}\}', text, flags=re.I|re.S)
         for hat in hats:
-            links = [self.clean_link(f) for f in hat.split('|') if '=' not in f]
-            all_links.extend(links)
+            found_links.extend(f for f in hat.split('|') if '=' not in f)
 
-        return set(self.filter_links(all_links))
-
-    def get_transcludes(self, text):
-        all_transcludes = []
+        # Same link is often repeated: clean and filter each only once
+        links = set(self.filter_links(set(self.clean_link(link) for link in set(found_links))))
+        return links, self.read_transcludes(found_transcludes)
 
+    def read_transcludes(self, found):
         # ---- Article transclusion ----
         # Ignore targets
         # eg. {{:Software engineering}}
-        matches = re.findall(r'\{\{:([^|#}]+).*?\}\}', text, flags=re.S)
-        all_transcludes.extend(matches)
+        return set(self.filter_links(found))
 
-        # ---- Template transclusion ----
-        # Obtain from HTML since it's hard to reduce false positives,
-        # even if we limit to only those without arguments
-        # {{...}} is same as {{Template:...}}
-        # eg. {{Template:Software engineering}}, {{Software engineering}}
-        # Ignore targets
-        # matches = re.findall(r'\{\{([^|#}]+).*?\}\}', text, flags=re.M)
 
-        return set(self.filter_links(all_transcludes))
+class NavboxLinkExtractor(HTMLParser):
+    ''' Collect hrefs of links within navboxes while HTML is parsed as a stream.
+    No document tree is built: only the stack of open elements is tracked, along with
+    whether each is within a navbox.
+    '''
+
+    navbox_classes = {'navbox', 'vertical-navbox'}
+    void_tags = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+                 'meta', 'param', 'source', 'track', 'wbr'}
+
+    def __init__(self):
+        super().__init__()
+        self.stack = [] # (tag, within a navbox)
+        self.hrefs = []
+
+    def handle_starttag(self, tag, attrs):
+        within = bool(self.stack) and self.stack[-1][1]
+        if tag == 'a':
+            if within:
+                # can be missing for selflinks
+                href = dict(attrs).get('href')
+                if href is not None: self.hrefs.append(href)
+        elif not within:
+            # .navbox with .authority-control to be ignored
+            classes = set((dict(attrs).get('class') or '').split())
+            within = bool(classes & self.navbox_classes) and 'authority-control' not in classes
+        if tag not in self.void_tags:
+            self.stack.append((tag, within))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.void_tags:
+            self.stack.pop()
+
+    def handle_endtag(self, tag):
+        # Unmatched end tags are ignored; unclosed elements are closed by their parent's end tag
+        for i in range(len(self.stack)-1, -1, -1):
+            if self.stack[i][0] == tag:
+                del self.stack[i:]
+                break
 
 
 class HtmlParser(Parser):
@@ -186,18 +289,17 @@ class HtmlParser(Parser):
         all_transcludes = []
 
         # ---- Template transclusion ----
-        root = BeautifulSoup(text, 'lxml')
-        for css in ('.vertical-navbox', '.navbox'):
-            for elem in root.select(css):
-                # .navbox with .authority-control to be ignored
-                if 'authority-control' in elem['class']: continue
-
-                for a in elem.select('a'):
-                    # can happen for selflinks
-                    if not a.has_attr('href'): continue
-
-                    href = re.sub(r'^/wiki/', '', a['href'])
-                    href = re.sub(r'#.*', '', href.replace('_', ' '))
-                    all_transcludes.append(href)
+        # Navboxes are usually at the end of a page: start parsing at the first one
+        start = text.find('navbox')
+        if start < 0: return set()
+        start = text.rfind('<', 0, start)
+
+        extractor = NavboxLinkExtractor()
+        extractor.feed(text[max(start, 0):])
+        extractor.close()
+        for href in extractor.hrefs:
+            href = re.sub(r'^/wiki/', '', href)
+            href = re.sub(r'#.*', '', href.replace('_', ' '))
+            all_transcludes.append(href)
 
         return set(self.filter_links(all_transcludes))
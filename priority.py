@@ -0,0 +1,46 @@
+import heapq
+import sys
+import zlib
+
+
+class TitlePriority:
+    ''' Decide which pending titles are crawled first when not all of them fit in a crawl.
+    Each priority function gives a key for a title, smaller keys first. Titles are ordered
+    by the first function, ties broken by the next and finally by the title itself:
+    the same titles are picked for the same state, run after run.
+        inlinks: titles linked from more crawled articles, the central articles of a topic
+        words: titles of fewer words, more often general topics than specific ones
+        hash: a fixed spread over titles, like a random sample but repeatable
+    In-link counts are kept in the state store: they persist across runs.
+    '''
+
+    functions = ('inlinks', 'words', 'hash')
+
+    def __init__(self, store, names=None):
+        self.store = store
+        self.names = names or ['inlinks', 'hash']
+        for name in self.names:
+            if name not in self.functions:
+                sys.exit("ERR: Unknown frontier priority '{}'. Use one of {}. Quitting...".format(
+                    name, ', '.join(self.functions)))
+
+    def keys(self, titles):
+        ''' Return a sort key for each of the titles. '''
+        counts = self.store.get_inlinks(titles) if 'inlinks' in self.names else {}
+        funcs = {
+            'inlinks': lambda t: -counts.get(t, 0),
+            'words': lambda t: t.count(' ') + 1,
+            'hash': lambda t: zlib.crc32(t.encode('utf-8'))
+        }
+        funcs = [funcs[name] for name in self.names]
+        return [tuple(f(t) for f in funcs) + (t,) for t in titles]
+
+    def top(self, titles, num):
+        ''' Return a set of the num titles of highest priority.
+        Heapify is linear: popping num of M titles costs O(M + num log M).
+        '''
+        if num <= 0:
+            return set()
+        heap = self.keys(titles)
+        heapq.heapify(heap)
+        return set(heapq.heappop(heap)[-1] for _ in range(min(num, len(heap))))
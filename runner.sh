@@ -24,17 +24,9 @@ else
 fi
 
 
-iter=0
-PendingFile="$basepath"/$odir/pending_titles.txt
-while [ -s  "$PendingFile" ]
-do
-    iter=$((iter+1))
-    printf "======== Iteration %03d ========\n" $iter
-    lines=$(wc -l "$PendingFile")
-    echo Pending titles $lines...
-    $PYPATH main.py -r -b "$basepath" -d $odir -m 100 -l 3
-    if [ $? -ne 0 ]
-    then
-        exit
-    fi
-done
+# One process crawls until nothing is pending: setup is done only once
+# Ctrl-C or SIGTERM stops it after the current batch with everything saved
+StateFile="$basepath"/$odir/crawl_state.db
+lines=$($PYPATH state_store.py "$StateFile" pending)
+echo Pending titles $lines...
+$PYPATH main.py -r -b "$basepath" -d $odir -m 100 -l 3 --daemon
@@ -0,0 +1,181 @@
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import time
+from crawl_stats import stats
+
+
+class ThrottledError(Exception):
+    ''' Server asked us to slow down: HTTP 429/503 or API errors maxlag/ratelimited.
+    '''
+
+    def __init__(self, retry_after=None, reason=''):
+        super().__init__("Throttled by server{}{}".format(
+            ': ' + reason if reason else '',
+            ', retry after {}s'.format(retry_after) if retry_after else ''))
+        self.retry_after = retry_after
+
+    @classmethod
+    def parse_retry_after(cls, value):
+        # Only the delay-seconds form is used by MediaWiki
+        try:
+            return max(0.0, float(value))
+        except (TypeError, ValueError):
+            return None
+
+
+class AimdController:
+    ''' Decide how many requests may be in flight: additive increase, multiplicative decrease.
+    Limit grows by one after a full window of successful requests. It's cut by a factor
+    when the server throttles us, and no request is started until the server's
+    Retry-After delay has passed.
+    '''
+
+    def __init__(self, initial=4, maximum=32, minimum=1, increase=1, decrease=0.5, backoff=1.0):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = max(self.minimum, min(initial, self.maximum))
+        self.increase = increase
+        self.decrease = decrease
+        self.backoff = backoff # seconds, when server doesn't say
+        self.acks = 0
+        self.resume_at = 0
+
+    def success(self):
+        self.acks += 1
+        if self.acks >= self.limit:
+            self.acks = 0
+            self.limit = min(self.maximum, self.limit + self.increase)
+
+    def throttle(self, retry_after=None):
+        self.acks = 0
+        self.limit = max(self.minimum, int(self.limit * self.decrease))
+        delay = retry_after if retry_after is not None else self.backoff
+        self.resume_at = max(self.resume_at, time.monotonic() + delay)
+
+    def paused_for(self):
+        return max(0, self.resume_at - time.monotonic())
+
+
+class Scheduler:
+    ''' Call an API function once for each item, as fast as the server allows.
+    Items that fail are put back into a retry queue. An item is given up only
+    after max_retries attempts. Items given up are collected in 'failed'.
+    If room is given, items are started only while room() is true: results aren't
+    fetched faster than they're taken. If stop is given, no item is started once it's set;
+    items not started are collected in 'failed'.
+    '''
+
+    poll = 0.05 # seconds between checks for room
+
+    def __init__(self, api_func, controller, max_retries=5, backoff=1.0, room=None, stop=None):
+        self.api_func = api_func
+        self.controller = controller
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.room = room
+        self.stop = stop
+        self.failed = []
+
+    def start(self, items):
+        # Retry queue and first attempts are in one heap ordered by time of next attempt
+        self.queue = []
+        self.seq = itertools.count()
+        for item in items:
+            self.requeue(item, 0, 0)
+
+    def requeue(self, item, attempt, delay):
+        heapq.heappush(self.queue, (time.monotonic() + delay, next(self.seq), item, attempt))
+
+    def has_room(self):
+        return self.room is None or self.room()
+
+    def stopped(self):
+        return self.stop is not None and self.stop.is_set()
+
+    def pending(self):
+        ''' True while there are items yet to start. Once stopped, these are given up. '''
+        if self.queue and self.stopped():
+            self.failed.extend(entry[2] for entry in sorted(self.queue))
+            self.queue = []
+        return bool(self.queue)
+
+    def ready(self, num_inflight):
+        ''' Pop items that can be started now given the current limit.
+        '''
+        items = []
+        if self.controller.paused_for() > 0 or not self.has_room():
+            return items
+        now = time.monotonic()
+        while self.queue and self.queue[0][0] <= now and num_inflight + len(items) < self.controller.limit:
+            items.append(heapq.heappop(self.queue)[2:])
+        return items
+
+    def wait_time(self, num_inflight):
+        ''' How long to wait before trying to start more items. None to wait for a completion.
+        '''
+        if not self.queue:
+            return None
+        if not self.has_room():
+            return self.poll
+        if num_inflight and num_inflight >= self.controller.limit:
+            return None
+        delay = max(self.queue[0][0] - time.monotonic(), self.controller.paused_for())
+        return max(delay, 0.01)
+
+    def finish(self, item, attempt, future, on_result):
+        try:
+            content = future.result()
+        except ThrottledError as exc:
+            stats.count('api_throttled')
+            self.controller.throttle(exc.retry_after)
+            self.retry(item, attempt, exc, 0)
+        except Exception as exc:
+            self.retry(item, attempt, exc, self.backoff * 2**attempt)
+        else:
+            self.controller.success()
+            on_result(item, content)
+
+    def retry(self, item, attempt, exc, delay):
+        if attempt + 1 < self.max_retries:
+            print('%r generated an exception: %s. Retrying...' % (item, exc))
+            stats.count('api_retries')
+            self.requeue(item, attempt + 1, delay)
+        else:
+            print('%r generated an exception: %s. Giving up.' % (item, exc))
+            stats.count('api_failures')
+            self.failed.append(item)
+
+    def run_threads(self, items, on_result):
+        self.start(items)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.controller.maximum) as executor:
+            inflight = {}
+            while self.pending() or inflight:
+                for item, attempt in self.ready(len(inflight)):
+                    inflight[executor.submit(self.api_func, item)] = (item, attempt)
+
+                timeout = self.wait_time(len(inflight))
+                if not inflight:
+                    time.sleep(timeout)
+                    continue
+                done, _ = concurrent.futures.wait(
+                    inflight, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    self.finish(*inflight.pop(future), future, on_result)
+
+    async def run_async(self, items, on_result):
+        self.start(items)
+        inflight = {}
+        while self.pending() or inflight:
+            for item, attempt in self.ready(len(inflight)):
+                inflight[asyncio.ensure_future(self.api_func(item))] = (item, attempt)
+
+            timeout = self.wait_time(len(inflight))
+            if not inflight:
+                await asyncio.sleep(timeout)
+                continue
+            done, _ = await asyncio.wait(
+                inflight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                self.finish(*inflight.pop(future), future, on_result)
@@ -0,0 +1,471 @@
+import math
+import os
+import socket
+import sqlite3
+import sys
+import time
+import zlib
+from data_saver import RevisionSaver, TextSaver, TitleSaver
+
+
+class StateStore:
+    ''' Keep the state of a crawl in a SQLite database rather than text files.
+    Titles have a status (crawled, discarded, redirected, pending, next_pending) and
+    the level at which they got that status. Crawled pages are kept by page ID with
+    their title and revision ID. Changes are saved only when commit() is called,
+    so that the state on disk is always that of a completed batch.
+    '''
+
+    statuses = ('crawled', 'discarded', 'redirected', 'pending', 'next_pending', 'batch')
+    # Titles with any of these need not be crawled
+    seen_statuses = ('crawled', 'discarded', 'redirected')
+    chunk = 500 # titles per query, below SQLite's limit on parameters
+
+    def __init__(self, fname):
+        self.fname = fname
+        is_new = not os.path.exists(fname)
+        # Other workers of a shared crawl may be writing: wait for them
+        self.db = sqlite3.connect(fname, timeout=60)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS titles (
+                title TEXT NOT NULL, status TEXT NOT NULL, level INTEGER,
+                PRIMARY KEY (title, status)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS titles_status ON titles (status, title);
+            CREATE TABLE IF NOT EXISTS pages (
+                pageid INTEGER PRIMARY KEY, title TEXT, revid INTEGER, level INTEGER);
+            CREATE INDEX IF NOT EXISTS pages_title ON pages (title);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS inlinks (title TEXT PRIMARY KEY, count INTEGER) WITHOUT ROWID;
+        ''')
+        self.is_new = is_new
+        self.level = 1 # level given to titles added from now on
+        self.seen = None # Bloom filter of seen titles, if enabled
+
+    def titles(self, status):
+        ''' Return a set-like view of titles that have this status. '''
+        if status not in self.statuses:
+            raise ValueError("Unknown title status '{}'".format(status))
+        return TitleSet(self, status)
+
+    @property
+    def pageids(self):
+        return PageSet(self)
+
+    @property
+    def revids(self):
+        return RevisionMap(self)
+
+    def use_filter(self):
+        ''' Keep a Bloom filter of seen titles, so that most titles that are not seen
+        are known to be so without a query. Building it reads all seen titles once:
+        worth it only in a long-running process.
+        '''
+        self.seen = BloomFilter(2 * sum(self.count(status) for status in self.seen_statuses))
+        for row in self.db.execute('SELECT title FROM titles WHERE status IN ({})'.format(
+                ','.join('?' * len(self.seen_statuses))), self.seen_statuses):
+            self.seen.add(row[0])
+
+    def discard_seen(self, titles):
+        ''' Remove from a plain set, in place, titles that are crawled, discarded or redirected.
+        One query for all three, and only for titles that pass the filter, if any.
+        '''
+        if self.seen is not None:
+            if self.seen.is_full(): self.use_filter()
+            candidates = [t for t in titles if t in self.seen]
+        else:
+            candidates = list(titles)
+        for i in range(0, len(candidates), self.chunk):
+            chunk = candidates[i:i+self.chunk]
+            rows = self.db.execute('SELECT title FROM titles WHERE title IN ({}) AND status IN ({})'.format(
+                ','.join('?' * len(chunk)), ','.join('?' * len(self.seen_statuses))),
+                chunk + list(self.seen_statuses))
+            titles.difference_update(row[0] for row in rows)
+        return titles
+
+    def add_inlinks(self, counts):
+        ''' Add to the number of crawled articles that link to each title. '''
+        self.db.executemany('''INSERT INTO inlinks VALUES (?,?)
+                               ON CONFLICT(title) DO UPDATE SET count=count+excluded.count''', counts)
+
+    def get_inlinks(self, titles):
+        ''' Return number of crawled articles that link to each of the titles, if any. '''
+        counts = {}
+        titles = list(titles)
+        for i in range(0, len(titles), self.chunk):
+            chunk = titles[i:i+self.chunk]
+            counts.update(self.db.execute('SELECT title, count FROM inlinks WHERE title IN ({})'.format(
+                ','.join('?' * len(chunk))), chunk))
+        return counts
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?,?)', (key, str(value)))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def count(self, status):
+        return self.db.execute('SELECT COUNT(*) FROM titles WHERE status=?', (status,)).fetchone()[0]
+
+    def migrate(self, files):
+        ''' Load state from text files of a crawl made before this store existed.
+        Only done when the store is new. Text files are left as they are.
+        A pending file alone is enough: it's the way to crawl a given list of titles.
+        '''
+        if not self.is_new or not any(os.path.exists(files[k]) for k in ('crawled', 'pending')):
+            return False
+
+        print("Migrating crawl state from text files to {}...".format(self.fname))
+        for status in ('crawled', 'discarded', 'redirected', 'pending', 'next_pending'):
+            self.titles(status).update(TitleSaver.read_title_file(files[status]))
+        self.pageids.update(TitleSaver.read_title_file(files['crawled_ids']))
+        revids = self.revids
+        for pageid, revid in RevisionSaver.read_revision_file(files['crawled_revids']).items():
+            revids[pageid] = revid
+        try:
+            self.set_meta('curr_level', int(TextSaver.read_file(files['curr_level'])))
+        except FileNotFoundError:
+            pass
+        self.commit()
+        return True
+
+
+class TitleSet:
+    ''' Set of titles of one status in a StateStore.
+    Supports the set operations used on plain sets of titles, including
+    plain_set - title_set and plain_set -= title_set, which return plain sets.
+    '''
+
+    chunk = StateStore.chunk
+
+    def __init__(self, store, status):
+        self.store = store
+        self.db = store.db
+        self.status = status
+
+    def level(self):
+        return self.store.level + (1 if self.status == 'next_pending' else 0)
+
+    def __len__(self):
+        return self.store.count(self.status)
+
+    def __bool__(self):
+        return self.db.execute('SELECT 1 FROM titles WHERE status=? LIMIT 1', (self.status,)).fetchone() is not None
+
+    def __iter__(self):
+        rows = self.db.execute('SELECT title FROM titles WHERE status=?', (self.status,)).fetchall()
+        return (row[0] for row in rows)
+
+    def __contains__(self, title):
+        return self.db.execute('SELECT 1 FROM titles WHERE title=? AND status=?',
+                               (title, self.status)).fetchone() is not None
+
+    def add(self, title):
+        self.update((title,))
+
+    def update(self, titles):
+        level = self.level()
+        if self.store.seen is not None and self.status in self.store.seen_statuses:
+            titles = list(titles)
+            for t in titles: self.store.seen.add(t)
+        self.db.executemany('INSERT OR IGNORE INTO titles VALUES (?,?,?)',
+                            ((t, self.status, level) for t in titles))
+
+    def discard(self, title):
+        self.difference_update((title,))
+
+    def difference_update(self, titles):
+        if isinstance(titles, TitleSet) and titles.db is self.db:
+            self.db.execute('''DELETE FROM titles WHERE status=? AND title IN
+                               (SELECT title FROM titles WHERE status=?)''', (self.status, titles.status))
+        else:
+            self.db.executemany('DELETE FROM titles WHERE title=? AND status=?',
+                                ((t, self.status) for t in titles))
+
+    def clear(self):
+        self.db.execute('DELETE FROM titles WHERE status=?', (self.status,))
+
+    def replace(self, titles):
+        titles = set(titles) # may be derived from this set
+        self.clear()
+        self.update(titles)
+
+    def members(self, titles):
+        ''' Return those of the given titles that are in this set. '''
+        found = set()
+        titles = list(titles)
+        for i in range(0, len(titles), self.chunk):
+            chunk = titles[i:i+self.chunk]
+            rows = self.db.execute('SELECT title FROM titles WHERE status=? AND title IN ({})'.format(
+                ','.join('?' * len(chunk))), [self.status] + chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    def __ior__(self, titles):
+        self.update(titles)
+        return self
+
+    def __isub__(self, titles):
+        self.difference_update(titles)
+        return self
+
+    def __sub__(self, titles):
+        return set(self) - set(titles)
+
+    def __rsub__(self, titles):
+        titles = set(titles)
+        return titles - self.members(titles)
+
+
+class BloomFilter:
+    ''' Compact set of strings, about 10 bits per string. It may say that a string is in it
+    when it's not, about once in a hundred at capacity, but never that a string is not in it
+    when it is. Strings can't be removed.
+    '''
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1024, capacity)
+        self.num_bits = int(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def add(self, s):
+        # All positions from two halves of one hash, as good as independent hashes.
+        # hash() of a string differs between processes: the filter is never saved.
+        h = hash(s)
+        h1, h2, bits = h & 0xFFFFFFFF, (h >> 32) | 1, self.bits
+        for i in range(self.num_hashes):
+            pos = (h1 + i * h2) % self.num_bits
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, s):
+        h = hash(s)
+        h1, h2, bits = h & 0xFFFFFFFF, (h >> 32) | 1, self.bits
+        for i in range(self.num_hashes):
+            pos = (h1 + i * h2) % self.num_bits
+            if not bits[pos >> 3] >> (pos & 7) & 1:
+                return False
+        return True
+
+    def is_full(self):
+        return self.count > self.capacity
+
+
+class PageSet:
+    ''' Set of page IDs of crawled pages in a StateStore. Page IDs may be int or str. '''
+
+    def __init__(self, store):
+        self.store = store
+        self.db = store.db
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def __iter__(self):
+        rows = self.db.execute('SELECT pageid FROM pages').fetchall()
+        return (str(row[0]) for row in rows)
+
+    def __contains__(self, pageid):
+        return self.db.execute('SELECT 1 FROM pages WHERE pageid=?', (int(pageid),)).fetchone() is not None
+
+    def add(self, pageid, title=None):
+        ''' Return True if the page is new: with many workers, only one of them gets True. '''
+        cursor = self.db.execute('INSERT OR IGNORE INTO pages (pageid, title, level) VALUES (?,?,?)',
+                                 (int(pageid), title, self.store.level))
+        return cursor.rowcount == 1
+
+    def update(self, pageids):
+        for pageid in pageids:
+            self.add(pageid)
+
+
+class RevisionMap:
+    ''' Map of page ID to revision ID of crawled pages in a StateStore. '''
+
+    def __init__(self, store):
+        self.store = store
+        self.db = store.db
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM pages WHERE revid IS NOT NULL').fetchone()[0]
+
+    def get(self, pageid, default=None):
+        row = self.db.execute('SELECT revid FROM pages WHERE pageid=?', (int(pageid),)).fetchone()
+        return row[0] if row and row[0] is not None else default
+
+    def __setitem__(self, pageid, revid):
+        self.db.execute('INSERT OR IGNORE INTO pages (pageid, level) VALUES (?,?)', (int(pageid), self.store.level))
+        self.db.execute('UPDATE pages SET revid=? WHERE pageid=?', (revid, int(pageid)))
+
+
+class SharedFrontier:
+    ''' Pending titles of a StateStore shared by many worker processes, on one host or on
+    hosts that share the crawl folder. Statuses mean what they mean to a single process:
+    pending titles are of the current level, next_pending titles of the next one. When no
+    title of the current level is left, next_pending titles become pending and the level
+    in meta 'curr_level' moves on. Titles of the current level are also kept in table
+    frontier with their partition, a hash of the title, and their number of in-links:
+    a worker claims the most linked titles of its own partition first and those of other
+    partitions when its own is done. A claim is a lease that expires: titles claimed by a
+    worker that died are claimed again by others.
+    '''
+
+    def __init__(self, store, worker, num_workers, lease_secs=600):
+        self.store = store
+        self.db = store.db
+        self.worker = worker
+        self.num_workers = num_workers
+        self.lease_secs = lease_secs
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), worker)
+        self.db.create_function('partition', 1, self.partition, deterministic=True)
+        store.commit()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            for sql in (
+                'CREATE TABLE IF NOT EXISTS leases (title TEXT PRIMARY KEY, owner TEXT, expires REAL)',
+                '''CREATE TABLE IF NOT EXISTS frontier (
+                   title TEXT PRIMARY KEY, part INTEGER NOT NULL, inlinks INTEGER NOT NULL) WITHOUT ROWID''',
+                'CREATE INDEX IF NOT EXISTS frontier_part ON frontier (part, inlinks DESC, title)',
+                'CREATE INDEX IF NOT EXISTS frontier_inlinks ON frontier (inlinks DESC, title)'):
+                self.db.execute(sql)
+            # Pending titles may have changed in runs of a single process
+            self.db.execute('''DELETE FROM frontier WHERE title NOT IN
+                               (SELECT title FROM titles WHERE status='pending')''')
+            self.fill()
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+
+    def partition(self, title):
+        # Same in every process, unlike hash()
+        return zlib.crc32(title.encode('utf-8')) % self.num_workers
+
+    def fill(self):
+        ''' Add pending titles missing from the frontier: partition is found once per title. '''
+        self.db.execute('''INSERT INTO frontier
+                           SELECT t.title, partition(t.title), COALESCE(i.count, 0)
+                           FROM titles t LEFT JOIN inlinks i ON i.title=t.title
+                           WHERE t.status='pending' AND t.title NOT IN (SELECT title FROM frontier)''')
+
+    def curr_level(self):
+        return int(self.store.get_meta('curr_level', 1))
+
+    def next_level(self, max_level):
+        ''' Make titles of the next level pending, if it's within max_level. Return True if any. '''
+        level = self.curr_level() + 1
+        if level > max_level or self.db.execute("SELECT 1 FROM titles WHERE status='next_pending' LIMIT 1").fetchone() is None:
+            return False
+        self.db.execute('''INSERT OR IGNORE INTO titles
+                           SELECT title, 'pending', ? FROM titles WHERE status='next_pending' ''', (level,))
+        self.db.execute("DELETE FROM titles WHERE status='next_pending'")
+        self.store.set_meta('curr_level', level)
+        self.fill()
+        return True
+
+    def claim(self, num, max_level):
+        ''' Lease up to num pending titles, moving on to the next level up to max_level when
+        no title of the current level is left. Return the level and the titles,
+        or (None, set()) if there's nothing to claim now.
+        '''
+        self.store.commit()
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE') # one worker claims at a time
+        try:
+            self.db.execute('DELETE FROM leases WHERE expires < ?', (now,))
+            titles = set()
+            # Leased titles are pending until they're crawled: a level ends when all are crawled
+            has_pending = self.db.execute("SELECT 1 FROM titles WHERE status='pending' LIMIT 1").fetchone()
+            level = self.curr_level()
+            if level > max_level or (has_pending is None and not self.next_level(max_level)):
+                level = None
+            else:
+                level = self.curr_level()
+                # Most linked titles first, as in TitlePriority: these are found by walking an index
+                for where, params in (('part=? AND', (self.worker,)), ('', ())):
+                    rows = self.db.execute('''SELECT title FROM frontier WHERE {}
+                                              title NOT IN (SELECT title FROM leases)
+                                              ORDER BY inlinks DESC, title LIMIT ?'''.format(where),
+                                           params + (num - len(titles),))
+                    titles.update(row[0] for row in rows)
+                    if len(titles) >= num: break
+                self.db.executemany('INSERT INTO leases VALUES (?,?,?)',
+                                    ((t, self.owner, now + self.lease_secs) for t in titles))
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        return level, titles
+
+    def renew(self):
+        ''' Extend leases of this worker: call this while a batch is being crawled. '''
+        self.db.execute('UPDATE leases SET expires=? WHERE owner=?', (time.time() + self.lease_secs, self.owner))
+
+    def add_current(self, titles, level):
+        ''' Add titles to the current level, unless they're pending or seen already.
+        They're added to the frontier too: else no worker claims them and the level never ends.
+        '''
+        titles = list(titles)
+        self.db.executemany('''INSERT OR IGNORE INTO titles SELECT ?, 'pending', ?
+                               WHERE NOT EXISTS (SELECT 1 FROM titles WHERE title=? AND status IN
+                               ('pending', 'crawled', 'discarded', 'redirected'))''', ((t, level, t) for t in titles))
+        self.db.executemany('''INSERT OR IGNORE INTO frontier
+                               SELECT t.title, partition(t.title), COALESCE(i.count, 0)
+                               FROM titles t LEFT JOIN inlinks i ON i.title=t.title
+                               WHERE t.title=? AND t.status='pending' ''', ((t,) for t in titles))
+
+    def add(self, titles, level):
+        ''' Add titles of the next level, unless they're pending or seen already. '''
+        self.db.executemany('''INSERT OR IGNORE INTO titles SELECT ?, 'next_pending', ?
+                               WHERE NOT EXISTS (SELECT 1 FROM titles WHERE title=? AND status IN
+                               ('pending', 'crawled', 'discarded', 'redirected'))''', ((t, level, t) for t in titles))
+
+    def remove(self, titles):
+        # Neither pending nor leased
+        self.db.executemany("DELETE FROM titles WHERE title=? AND status IN ('pending', 'next_pending')",
+                            ((t,) for t in titles))
+        self.db.executemany('DELETE FROM frontier WHERE title=?', ((t,) for t in titles))
+        self.db.executemany('DELETE FROM leases WHERE title=? AND owner=?', ((t, self.owner) for t in titles))
+
+    def complete(self, titles, level):
+        ''' Titles have been crawled. '''
+        titles = list(titles)
+        self.db.executemany("INSERT OR IGNORE INTO titles VALUES (?,'crawled',?)", ((t, level) for t in titles))
+        self.remove(titles)
+
+    def fail(self, titles, level):
+        ''' Titles failed: no worker tries them again in this level. They're retried with the next
+        level, saved with the same commit as the batch.
+        '''
+        titles = list(titles)
+        self.remove(titles)
+        self.db.executemany("INSERT OR IGNORE INTO titles VALUES (?,'next_pending',?)", ((t, level) for t in titles))
+
+    def release(self):
+        ''' Give up all leases of this worker: their titles can be claimed by others now. '''
+        self.db.execute('DELETE FROM leases WHERE owner=?', (self.owner,))
+        self.store.commit()
+
+    def num_leased(self):
+        ''' Number of titles leased by other workers: they may yet find more titles. '''
+        return self.db.execute('SELECT COUNT(*) FROM leases WHERE owner!=? AND expires >= ?',
+                               (self.owner, time.time())).fetchone()[0]
+
+
+if __name__ == '__main__':
+    # Used by runner.sh: state_store.py {dbfile} {status} prints number of titles with the status
+    if len(sys.argv) != 3 or sys.argv[2] not in StateStore.statuses:
+        sys.exit("Usage: state_store.py {dbfile} {status}")
+    if not os.path.exists(sys.argv[1]):
+        print(0)
+    else:
+        print(StateStore(sys.argv[1]).count(sys.argv[2]))
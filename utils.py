@@ -6,7 +6,7 @@ import argparse
 from datetime import datetime
 import json
 import os
-import random
+import signal
 import sys
 
 
@@ -30,6 +30,32 @@ def parse_args():
     parser.add_argument('-r','--restricted', action='store_true', required=False,
         help='''Parse article content in a restricted manner when identifying more articles to crawl.
                 Not relevant when seeding.''')
+    parser.add_argument('--daemon', action='store_true', required=False,
+        help='''Keep crawling, up to maximum number of pages at a time, until there's nothing left to crawl
+                or the process is stopped by Ctrl-C or SIGTERM. Not relevant when seeding.''')
+    parser.add_argument('--bulk', action='store_true', required=False,
+        help='''Get only wikitext of articles, many articles per API call. Much fewer calls are made
+                but HTML and other parsed content are not saved. Not relevant when seeding.''')
+    parser.add_argument('--metrics-port', required=False, default=None, type=int, metavar='PORT',
+        help='''Serve stats of the crawl in Prometheus text format at http://127.0.0.1:PORT/metrics.
+                Useful with --daemon.''')
+    parser.add_argument('--metrics-host', required=False, default='127.0.0.1', metavar='HOST',
+        help='''Address that metrics are served at. Only this host can reach them by default:
+                use 0.0.0.0 to serve them to other hosts. Used with --metrics-port.''')
+    parser.add_argument('--worker', required=False, default=None, type=int, metavar='I',
+        help='''Crawl as worker I (0, 1, ...) of a crawl shared by --workers processes, on this host or
+                on hosts sharing the crawl folder. Each worker writes its own article files.''')
+    parser.add_argument('--workers', required=False, default=None, type=int, metavar='N',
+        help='Number of workers of a shared crawl. Used with --worker.')
+    parser.add_argument('--memory-limit', required=False, default=None, type=int, metavar='MB',
+        help='''Keep memory in use below this many MB where possible: fetched articles are spilled
+                to disk while it's exceeded and HTML is not saved. Peak memory of each stage is reported.''')
+    parser.add_argument('--refresh', action='store_true', required=False,
+        help='''Get again articles of a previous crawl that have changed since they were crawled.
+                Up to maximum number of pages are refreshed. Not relevant when seeding.''')
+    parser.add_argument('--replay', action='store_true', required=False,
+        help='''Serve all API requests from the response cache without using the network.
+                Titles whose responses are not cached are treated as missing.''')
     parser.add_argument('-s','--seed', action='store_true', required=False,
         help='Crawl seed articles to discover other articles to crawl. The latter are added to pending list.')
 
@@ -40,6 +66,27 @@ def parse_args():
        not os.path.exists(os.path.join(args['basepath'], args['dir'])):
         parser.print_help()
         sys.exit("\nERR: Can't crawl articles. First seed using -s option.")
+    if args['refresh'] and args['seed']:
+        parser.print_help()
+        sys.exit("\nERR: Can't refresh when seeding. Use only one of -s and --refresh options.")
+    if args['daemon'] and (args['seed'] or args['refresh']):
+        parser.print_help()
+        sys.exit("\nERR: Can't run as daemon when seeding or refreshing. Seed first and then use --daemon.")
+    if args['refresh'] and args['replay']:
+        parser.print_help()
+        sys.exit("\nERR: Can't refresh from cached responses. Use only one of --refresh and --replay options.")
+    if (args['worker'] is None) != (args['workers'] is None):
+        parser.print_help()
+        sys.exit("\nERR: Shared crawl needs both --worker and --workers options.")
+    if args['workers'] is not None and not 0 <= args['worker'] < args['workers']:
+        parser.print_help()
+        sys.exit("\nERR: Out of range. Range for --worker option is 0-{}.".format(args['workers'] - 1))
+    if args['workers'] is not None and (args['seed'] or args['refresh']):
+        parser.print_help()
+        sys.exit("\nERR: Can't share a crawl when seeding or refreshing. Seed first and then start the workers.")
+    if args['memory_limit'] is not None and args['memory_limit'] < 1:
+        parser.print_help()
+        sys.exit("\nERR: Memory limit must be a positive number of MB.")
     if args['levels'] < 1 or args['levels'] > rmaxlevels:
         parser.print_help()
         sys.exit("\nERR: Out of range. Range for -l option is 1-{}.".format(rmaxlevels))
@@ -59,17 +106,37 @@ def read_config(fname):
         return json.loads(infile.read())
 
 
+def add_cache_config(api, args):
+    ''' Cache is shared by all crawls within the base path. '''
+    if 'cache' not in api:
+        api['cache'] = {}
+    if 'file' in api['cache'] and not os.path.isabs(api['cache']['file']):
+        api['cache']['file'] = os.path.join(args['basepath'], api['cache']['file'])
+    api['cache']['replay'] = args['replay']
+    # Refresh must see latest revisions: update cache but don't read from it
+    api['cache']['bypass'] = args['refresh']
+
+
+def add_parse_config(api, transcludes, args):
+    ''' HTML is needed only to get transcluded navboxes, which are not used when seeding.
+    In bulk mode, only wikitext of articles is fetched.
+    '''
+    api['html'] = transcludes['enabled'] and not args['seed']
+    if args['bulk'] and not args['seed']:
+        api['func'] = 'get_texts'
+
+
 def add_path(path, files):
     for k, v in files.items():
         files[k] = "{}/{}".format(path, v)
 
 
-def limit_titles(done_titles, todo_titles, limit):
-    '''Both arguments are modified. Returns excluded titles.'''
+def limit_titles(done_titles, todo_titles, limit, priority):
+    '''Both titles arguments are modified. Titles of highest priority are kept. Returns excluded titles.'''
     new_titles = todo_titles - done_titles # remove overlaps
     
     if len(new_titles) > limit - len(done_titles):
-        curr_titles = set(random.sample(new_titles, limit - len(done_titles)))
+        curr_titles = priority.top(new_titles, limit - len(done_titles))
     else:
         curr_titles = new_titles
     
@@ -78,3 +145,23 @@ def limit_titles(done_titles, todo_titles, limit):
     todo_titles |= curr_titles
     
     return  new_titles - curr_titles
+
+
+_stop = False
+
+def handle_interrupt():
+    ''' On first Ctrl-C or SIGTERM, only request a stop. Crawl stops after the current batch
+    and saves everything. Second Ctrl-C quits immediately.
+    '''
+    def handler(signum, frame):
+        global _stop
+        if _stop and signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        _stop = True
+        print("\nStopping after the current batch. Press Ctrl-C again to quit now.", flush=True)
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+
+def stop_requested():
+    return _stop